@@ -23,6 +23,7 @@ def register():
         html.Template,
         html.TemplateUsage,
         html.ReportTemplate,
+        translation.Translation,
         module=module, type_='model')
     Pool.register(
         translation.ReportTranslationSet,
@@ -1,14 +1,24 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from types import MappingProxyType
+
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pyson import Eval
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.cache import Cache
+from trytond.config import config
+from .cache import ClusterCache, get_asset
+from .analysis import free_variables
 
 __all__ = ['ActionReport', 'HTMLTemplateTranslation']
 
+ENVIRONMENT_CACHE_SIZE = config.getint('html_report', 'environment_cache_size',
+    default=64)
+TRANSLATION_CACHE_SIZE = config.getint('html_report',
+    'translation_cache_size', default=256)
+
 
 class ActionReport(metaclass=PoolMeta):
     __name__ = 'ir.action.report'
@@ -58,14 +68,20 @@ class ActionReport(metaclass=PoolMeta):
         help='Will raise a UserError in case of error in template parsing.')
     html_translations = fields.One2Many('html.template.translation', 'report',
         'Translations')
-    _html_translation_cache = Cache('html.template.translation',
-        size_limit=10240, context=False)
+    # Translations of each report and language
+    _html_translation_cache = ClusterCache('html.template.translation',
+        size_limit=TRANSLATION_CACHE_SIZE)
     html_header_content = fields.Function(fields.Binary('Header Content'),
         'get_content')
     html_footer_content = fields.Function(fields.Binary('Footer Content'),
         'get_content')
     html_last_footer_content = fields.Function(fields.Binary(
             'Last Page Footer Content'), 'get_content')
+    _html_environment_cache = ClusterCache('ir.action.report.html_environment',
+        size_limit=ENVIRONMENT_CACHE_SIZE)
+    # Assembled content of each report and slot with the files it was read from
+    _html_content_cache = Cache('ir.action.report.html_content',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -83,17 +99,131 @@ class ActionReport(metaclass=PoolMeta):
                     })]
 
     def get_content(self, name):
+        key = (self.id, name, self.write_date or self.create_date)
+        cached = self._html_content_cache.get(key)
+        if cached is not None:
+            content, files = cached
+            if files == self._get_files_version([f for f, _ in files]):
+                return content
+
         obj_name = name.replace('content', 'template')
         obj = getattr(self, obj_name)
         if not obj:
             return
 
-        content = []
-        for template in self.html_templates:
-            if template.template_used and template.template_used.all_content:
-                content.append(template.template_used.all_content or '')
-        content.append(obj.all_content or '')
-        return '\n\n'.join(content)
+        templates = [t.template_used for t in self.html_templates
+            if t.template_used]
+        templates.append(obj)
+        # The templates stored in files can change without being written
+        filenames = {t.filename for t in templates if t.filename}
+        filenames.update(f for f, _ in obj.get_all_sources() or [] if f)
+        files = self._get_files_version(sorted(filenames))
+        macros = self._get_macro_imports(obj)
+        if macros is not None:
+            imports, inlined = macros
+            content = '\n'.join(imports + ['', '\n\n'.join(
+                        [t.all_content for t in inlined]
+                        + [obj.all_content or ''])])
+        else:
+            content = '\n\n'.join(t.all_content or '' for t in templates
+                if t == obj or t.all_content)
+        if self.id is not None and self.id >= 0:
+            self._html_content_cache.set(key, (content, files))
+        return content
+
+    def _get_macro_imports(self, template):
+        """
+        Return the statements importing the macros of the report used by
+        template, each one after the macros it uses, and the macro templates
+        to define before template, or None if some of them call each other
+        or share the same name and must be defined in the same template.
+
+        The macros are loaded as templates of their own, so they are compiled
+        once and only by the templates that use them. All the macros of the
+        report are imported when the calls of template can not be found.
+
+        Imported macros only see the variables of the context when they are
+        imported, so the macros reading other variables, like the ones set by
+        template, and the macros calling them are defined before template.
+        """
+        macros = {t.signature: t.template_used for t in self.html_templates
+            if t.template_used and t.template_used.all_content}
+        names = [s.macro_name for s in macros]
+        if len(set(names)) != len(names):
+            return
+        Report = self._get_html_report()
+        if Report is None:
+            return
+        env = Report.get_cached_environment(self)
+        context_names = (Report.get_context_names() | set(env.globals)
+            | set(names))
+        imports, inlined, visited, visiting = [], [], set(), set()
+
+        def visit(signature):
+            if signature in visited:
+                return True
+            if signature in visiting:
+                return False
+            visiting.add(signature)
+            macro = macros[signature]
+            variables = free_variables(env, macro.all_content)
+            inline = variables is None or bool(variables - context_names)
+            for used in sorted(macro.get_current_uses(),
+                    key=lambda s: s.id):
+                if used == signature or used not in macros:
+                    continue
+                if not visit(used):
+                    return False
+                inline |= macros[used] in inlined
+            visiting.remove(signature)
+            visited.add(signature)
+            if inline:
+                inlined.append(macro)
+            else:
+                imports.append('{%% from "%s" import %s with context %%}' % (
+                        macro.id, signature.macro_name))
+            return True
+
+        uses = template.get_all_uses()
+        if uses is None:
+            uses = macros.keys()
+        for signature in sorted(uses, key=lambda s: s.id):
+            if signature in macros and not visit(signature):
+                return
+        return imports, inlined
+
+    def _get_html_report(self):
+        "Return the html report class rendering the report or None"
+        try:
+            Report = Pool().get(self.report_name, type='report')
+        except KeyError:
+            return
+        if hasattr(Report, 'get_context_names'):
+            return Report
+
+    @staticmethod
+    def _get_files_version(filenames):
+        "Return the filenames with the current mtime of their file"
+        version = []
+        for filename in filenames:
+            try:
+                mtime = get_asset(filename).mtime
+            except IOError:
+                mtime = None
+            version.append((filename, mtime))
+        return version
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._html_environment_cache.clear()
+        cls._html_content_cache.clear()
+
+    @classmethod
+    def delete(cls, reports):
+        super().delete(reports)
+        cls._html_environment_cache.clear()
+        cls._html_content_cache.clear()
 
     @classmethod
     def validate(cls, reports):
@@ -127,11 +257,11 @@ class ActionReport(metaclass=PoolMeta):
     def required_signatures(self):
         if not self.html_template:
             return set()
-        signatures = {x for x in self.html_template.uses}
+        signatures = set(self.html_template.get_current_uses())
         for template in self.html_templates:
             if not template.template:
                 continue
-            signatures |= {x for x in template.template.uses}
+            signatures |= set(template.template.get_current_uses())
         return signatures
 
     @fields.depends('html_template', 'html_templates')
@@ -174,23 +304,31 @@ class ActionReport(metaclass=PoolMeta):
 
 
     @classmethod
-    def gettext(cls, *args, **variables):
+    def get_html_translations(cls, report, lang):
+        """
+        Return a read-only dictionary mapping the sources of the report to
+        their translation in lang
+        """
         HTMLTemplateTranslation = Pool().get('html.template.translation')
+        key = (report, lang)
+        catalog = cls._html_translation_cache.get(key)
+        if catalog is None:
+            catalog = {}
+            for translation in HTMLTemplateTranslation.search_read([
+                        ('report', '=', report),
+                        ('lang', '=', lang),
+                        ], fields_names=['src', 'value']):
+                if translation['value']:
+                    catalog.setdefault(translation['src'],
+                        translation['value'])
+            catalog = cls._html_translation_cache.set(key,
+                MappingProxyType(catalog))
+        return catalog
 
+    @classmethod
+    def gettext(cls, *args, **variables):
         report, src, lang = args
-        key = (report, src, lang)
-        text = cls._html_translation_cache.get(key)
-        if text is None:
-            translations = HTMLTemplateTranslation.search([
-                ('report', '=', report),
-                ('src', '=', src),
-                ('lang', '=', lang),
-                ], limit=1)
-            if translations:
-                text = translations[0].value
-            else:
-                text = src
-            cls._html_translation_cache.set(key, text)
+        text = cls.get_html_translations(report, lang).get(src, src)
         return text if not variables else text % variables
 
 
@@ -0,0 +1,213 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from jinja2 import meta, nodes
+from jinja2.exceptions import TemplateError
+
+__all__ = ['RecordPathCollector', 'uses_variables', 'free_variables']
+
+# Attributes of DualRecord that give access to the fields of the same record
+PASSTHROUGH_ATTRIBUTES = {'raw', 'render'}
+
+
+class RecordPathCollector:
+    '''
+    Collect the dotted field paths used on the records of a report by a
+    Jinja template.
+
+    The paths are relative to the records of the report and are found by
+    following the names bound to them: the "record" and "records" variables,
+    the targets of for loops, set and with statements and the arguments of
+    the macros called with them. Templates referenced by extends, include
+    and import statements are analysed too.
+    '''
+
+    def __init__(self, env, roots=('record', 'records')):
+        self.env = env
+        self.roots = roots
+        self.paths = set()
+        self.macros = {}
+        self._visited_macros = set()
+        self._visited_templates = set()
+
+    def collect(self, source):
+        "Return the set of paths, as tuples of field names, used by source"
+        bindings = {name: () for name in self.roots}
+        for ast in self._parse(source):
+            for macro in ast.find_all(nodes.Macro):
+                self.macros.setdefault(macro.name, macro)
+        for ast in self._parse(source):
+            self._visit_body(ast.body, bindings)
+        return self.paths
+
+    def _parse(self, source, name=None):
+        "Yield the ast of source and of the templates it references"
+        if name is not None:
+            if name in self._visited_templates:
+                return
+            self._visited_templates.add(name)
+        try:
+            ast = self.env.parse(source)
+        except TemplateError:
+            return
+        yield ast
+        for node in ast.find_all((nodes.Extends, nodes.Include,
+                    nodes.Import, nodes.FromImport)):
+            if not isinstance(node.template, nodes.Const):
+                continue
+            template_name = str(node.template.value)
+            try:
+                template_source, _, _ = self.env.loader.get_source(self.env,
+                    template_name)
+            except TemplateError:
+                continue
+            yield from self._parse(template_source, template_name)
+
+    def _resolve(self, node, bindings):
+        "Return the path of the record node refers to or None"
+        if isinstance(node, nodes.Name):
+            return bindings.get(node.name)
+        elif isinstance(node, nodes.Getattr):
+            path = self._resolve(node.node, bindings)
+            if path is None:
+                return
+            if node.attr in PASSTHROUGH_ATTRIBUTES:
+                return path
+            path = path + (node.attr,)
+            self.paths.add(path)
+            return path
+        elif isinstance(node, nodes.Filter) and node.node is not None:
+            # Filters like sort or selectattr keep the records
+            return self._resolve(node.node, bindings)
+
+    def _visit_body(self, body, bindings):
+        bindings = bindings.copy()
+        for node in body:
+            self._visit(node, bindings)
+
+    def _visit(self, node, bindings):
+        if isinstance(node, nodes.For):
+            self._visit_expressions(node.iter, bindings)
+            body_bindings = bindings.copy()
+            path = self._resolve(node.iter, bindings)
+            if isinstance(node.target, nodes.Name):
+                if path is not None:
+                    body_bindings[node.target.name] = path
+                else:
+                    body_bindings.pop(node.target.name, None)
+            self._visit_body(node.body, body_bindings)
+            self._visit_body(node.else_, bindings)
+            if node.test is not None:
+                self._visit_expressions(node.test, body_bindings)
+            return
+        elif isinstance(node, nodes.Assign):
+            self._visit_expressions(node.node, bindings)
+            if isinstance(node.target, nodes.Name):
+                path = self._resolve(node.node, bindings)
+                if path is not None:
+                    bindings[node.target.name] = path
+                else:
+                    bindings.pop(node.target.name, None)
+            return
+        elif isinstance(node, nodes.With):
+            body_bindings = bindings.copy()
+            for target, value in zip(node.targets, node.values):
+                self._visit_expressions(value, bindings)
+                if isinstance(target, nodes.Name):
+                    path = self._resolve(value, bindings)
+                    if path is not None:
+                        body_bindings[target.name] = path
+                    else:
+                        body_bindings.pop(target.name, None)
+            self._visit_body(node.body, body_bindings)
+            return
+        elif isinstance(node, nodes.Macro):
+            # Macros are analysed where they are called
+            return
+        elif isinstance(node, nodes.Expr):
+            self._visit_expressions(node, bindings)
+            return
+        for child in node.iter_child_nodes():
+            self._visit(child, bindings)
+
+    def _visit_expressions(self, node, bindings):
+        for expression in [node] + list(node.find_all(nodes.Expr)):
+            if isinstance(expression, nodes.Getattr):
+                self._resolve(expression, bindings)
+            elif isinstance(expression, nodes.Call):
+                self._visit_call(expression, bindings)
+
+    def _visit_call(self, node, bindings):
+        if not isinstance(node.node, nodes.Name):
+            return
+        macro = self.macros.get(node.node.name)
+        if macro is None:
+            return
+        # Macros see the variables of the template context too
+        macro_bindings = {name: () for name in self.roots}
+        for arg in macro.args:
+            macro_bindings.pop(arg.name, None)
+        arguments = [(arg.name, value) for arg, value in zip(macro.args,
+                node.args)]
+        arguments += [(kwarg.key, kwarg.value) for kwarg in node.kwargs]
+        for name, value in arguments:
+            path = self._resolve(value, bindings)
+            if path is not None:
+                macro_bindings[name] = path
+        key = (macro.name, tuple(sorted(macro_bindings.items())))
+        if key in self._visited_macros:
+            return
+        self._visited_macros.add(key)
+        self._visit_body(macro.body, macro_bindings)
+
+
+def uses_variables(env, source, names=('record', 'records')):
+    '''
+    Return if the Jinja template source, or a template it extends, includes
+    or imports, reads any of the variables names.
+
+    The answer is conservative: templates that can not be analysed, like
+    the ones referenced by a dynamic name, are considered to read them.
+    '''
+    names = set(names)
+    sources, visited = [source], set()
+    while sources:
+        try:
+            ast = env.parse(sources.pop())
+        except TemplateError:
+            return True
+        for node in ast.find_all(nodes.Name):
+            if node.name in names:
+                return True
+        for node in ast.find_all((nodes.Extends, nodes.Include,
+                    nodes.Import, nodes.FromImport)):
+            if not isinstance(node.template, nodes.Const):
+                return True
+            template_name = str(node.template.value)
+            if template_name in visited:
+                continue
+            visited.add(template_name)
+            try:
+                template_source, _, _ = env.loader.get_source(env,
+                    template_name)
+            except TemplateError:
+                return True
+            sources.append(template_source)
+    return False
+
+
+def free_variables(env, source):
+    '''
+    Return the variables read by the Jinja template source that are not
+    defined by it or None if they can not be found.
+
+    Templates that extend, include or import other templates can not be
+    analysed, as the variables those templates read are not known.
+    '''
+    try:
+        ast = env.parse(source)
+        if next(ast.find_all((nodes.Extends, nodes.Include, nodes.Import,
+                        nodes.FromImport)), None) is not None:
+            return
+        return meta.find_undeclared_variables(ast)
+    except TemplateError:
+        return
@@ -0,0 +1,299 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import binascii
+import gettext
+import mimetypes
+import os
+import tempfile
+import threading
+import uuid
+from hashlib import sha1
+
+import jinja2
+from jinja2.bccache import Bucket
+from babel import support
+
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
+from trytond.tools import file_open
+from trytond.transaction import Transaction
+
+__all__ = ['LRUCache', 'ClusterCache', 'SourceBytecodeCache',
+    'get_bytecode_cache', 'compile_template', 'load_translations', 'Asset',
+    'get_asset', 'get_file']
+
+BYTECODE_CACHE_DIR = config.get('html_report', 'bytecode_cache_dir',
+    default=None)
+ASSET_CACHE_SIZE = config.getint('html_report', 'asset_cache_size',
+    default=256)
+ASSET_MAX_SIZE = config.getint('html_report', 'asset_max_size',
+    default=1024 * 1024)
+
+
+class LRUCache:
+    '''
+    Thread safe, process wide LRU cache with hit and miss counters.
+
+    Contrary to trytond.cache.Cache, values are stored as is (they are not
+    deep copied) so it can hold objects such as compiled templates.
+    '''
+    _instances = {}
+
+    def __init__(self, name, size_limit=1024):
+        assert name not in self._instances
+        self._name = name
+        self.size_limit = size_limit
+        self.hit = self.miss = 0
+        self._values = LRUDict(size_limit)
+        self._lock = threading.Lock()
+        self._instances[name] = self
+
+    @classmethod
+    def stats(cls):
+        for name, inst in cls._instances.items():
+            yield {
+                'name': name,
+                'hit': inst.hit,
+                'miss': inst.miss,
+                'size': len(inst._values),
+                }
+
+    def _key(self, key):
+        return key
+
+    def _valid(self, key, value):
+        return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._values.pop(self._key(key))
+            except (KeyError, TypeError):
+                self.miss += 1
+                return default
+            if not self._valid(key, value):
+                self.miss += 1
+                return default
+            self._values[self._key(key)] = value
+            self.hit += 1
+        return self._unwrap(value)
+
+    def _wrap(self, key, value):
+        return value
+
+    def _unwrap(self, value):
+        return value
+
+    def set(self, key, value):
+        wrapped = self._wrap(key, value)
+        with self._lock:
+            try:
+                self._values[self._key(key)] = wrapped
+            except TypeError:
+                pass
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class ClusterCache(LRUCache):
+    '''
+    LRUCache whose entries are invalidated on all processes when clear() is
+    called.
+
+    A trytond.cache.Cache holds a validity token for each key, so the values
+    themselves stay in the process while the invalidation follows the same
+    path as any other trytond cache.
+    '''
+
+    def __init__(self, name, size_limit=1024):
+        super().__init__(name, size_limit=size_limit)
+        self._tokens = Cache(name, size_limit=size_limit, context=False)
+
+    def _key(self, key):
+        return (Transaction().database.name, key)
+
+    def _valid(self, key, value):
+        return value[0] == self._tokens.get(key)
+
+    def _wrap(self, key, value):
+        token = uuid.uuid4().hex
+        self._tokens.set(key, token)
+        return (token, value)
+
+    def _unwrap(self, value):
+        return value[1]
+
+    def clear(self):
+        self._tokens.clear()
+
+
+class SourceBytecodeCache(jinja2.FileSystemBytecodeCache):
+    '''
+    Jinja bytecode cache stored in a directory shared by all the processes.
+
+    Buckets are keyed by the source of the template (besides its name and
+    the extensions of the environment) instead of its name only, so the
+    templates stored in html.template records never load the bytecode of a
+    previous version.
+    '''
+
+    def get_bucket(self, environment, name, filename, source):
+        key = sha1()
+        for part in sorted(environment.extensions) + [
+                name or '', filename or '', source]:
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        bucket = Bucket(environment, key.hexdigest(),
+            self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def dump_bytecode(self, bucket):
+        # Write into a temporary file and rename it, so the other processes
+        # never read a partially written file
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_name, self._get_cache_filename(bucket))
+        except Exception:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+
+_bytecode_cache = None
+
+
+def get_bytecode_cache():
+    '''
+    Return the bytecode cache of the bytecode_cache_dir option or None if it
+    is not set
+    '''
+    global _bytecode_cache
+    if _bytecode_cache is None and BYTECODE_CACHE_DIR:
+        os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+        _bytecode_cache = SourceBytecodeCache(BYTECODE_CACHE_DIR)
+    return _bytecode_cache
+
+
+def compile_template(env, source, name=None):
+    '''
+    Return the template of env for source like env.from_string() does but
+    going through the bytecode cache of the environment
+    '''
+    bcc = env.bytecode_cache
+    if bcc is None:
+        return env.from_string(source)
+    bucket = bcc.get_bucket(env, name, None, source)
+    if bucket.code is None:
+        bucket.code = env.compile(source, name)
+        bcc.set_bucket(bucket)
+    return env.template_class.from_code(env, bucket.code,
+        env.make_globals(None), None)
+
+
+# Babel catalogs keyed by directory, domain and locale
+_translations_cache = LRUCache('html_report.translations', size_limit=256)
+
+
+def load_translations(dirname, locale, domain=None):
+    '''
+    Return the Babel translations of locale found in dirname like
+    support.Translations.load() does, but parsing each MO file only once per
+    process until it is modified
+    '''
+    filename = gettext.find(domain or support.Translations.DEFAULT_DOMAIN,
+        dirname, [str(locale)])
+    mtime = os.stat(filename).st_mtime_ns if filename else None
+    key = (dirname, domain, str(locale))
+    cached = _translations_cache.get(key)
+    if cached is not None and cached[0] == (filename, mtime):
+        return cached[1]
+    translations = support.Translations.load(dirname=dirname,
+        locales=[locale], domain=domain)
+    _translations_cache.set(key, ((filename, mtime), translations))
+    return translations
+
+
+class Asset:
+    "File of a module with its content"
+    __slots__ = ('path', 'mtime', 'data', '_text', '_data_uri')
+
+    def __init__(self, path, mtime, data):
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self._text = None
+        self._data_uri = None
+
+    def uptodate(self):
+        "Return if the file was not modified since it was read"
+        try:
+            return os.stat(self.path).st_mtime_ns == self.mtime
+        except OSError:
+            return False
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.data.decode('utf-8')
+        return self._text
+
+    @property
+    def url(self):
+        return 'file://' + self.path
+
+    @property
+    def data_uri(self):
+        if self._data_uri is None:
+            value = binascii.b2a_base64(self.data).decode('ascii')
+            mimetype = mimetypes.guess_type(self.path)[0]
+            self._data_uri = ('data:%s;base64,%s' % (mimetype, value)).strip()
+        return self._data_uri
+
+
+# Files keyed by their module name or their path
+_asset_cache = LRUCache('html_report.asset', size_limit=ASSET_CACHE_SIZE)
+
+
+def _get_cached_asset(key):
+    "Return the Asset of key if its file was not modified since it was read"
+    asset = _asset_cache.get(key)
+    if asset is not None and asset.uptodate():
+        return asset
+
+
+def _read_asset(key, f):
+    asset = Asset(f.name, os.fstat(f.fileno()).st_mtime_ns, f.read())
+    if len(asset.data) <= ASSET_MAX_SIZE:
+        _asset_cache.set(key, asset)
+    return asset
+
+
+def get_asset(name):
+    '''
+    Return the Asset of name, a path inside a module like sale/sale.css
+
+    Files up to asset_max_size bytes are kept in memory until their mtime
+    changes. Raises IOError if the file does not exist.
+    '''
+    asset = _get_cached_asset(name)
+    if asset is None:
+        module, path = name.split('/', 1)
+        with file_open(os.path.join(module, path), 'rb') as f:
+            asset = _read_asset(name, f)
+    return asset
+
+
+def get_file(path):
+    "Return the Asset of the file at the absolute path like get_asset()"
+    key = ('file', path)
+    asset = _get_cached_asset(key)
+    if asset is None:
+        with open(path, 'rb') as f:
+            asset = _read_asset(key, f)
+    return asset
@@ -1,37 +1,114 @@
 import os
 import io
+import logging
+import threading
+import hashlib
 import binascii
 import mimetypes
+import tempfile
+import weakref
 import zipfile
 import qrcode
 import qrcode.image.svg
 import barcode
 from barcode.writer import SVGWriter
-from io import BytesIO
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
 from decimal import Decimal
 from datetime import date, datetime
 
 import jinja2
 import jinja2.ext
-from babel import dates, numbers, support
-
-import weasyprint
-from .generator import PdfGenerator
+from babel import dates, numbers
+
+from .generator import (PdfGenerator, RenderContext, PdfWriter, render_pdf,
+    merge_pdfs, get_pdf_pool, discard_pdf_pool, register_resource,
+    use_resource, get_active_render_context, join_record_htmls,
+    RECORD_PAGES_SUPPORTED)
+from .cache import (LRUCache, get_bytecode_cache, compile_template,
+    load_translations, get_asset)
+from .analysis import RecordPathCollector, uses_variables
+from trytond.model import Model, fields
 from trytond.model.fields.selection import TranslatedSelection
-from trytond.tools import file_open
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.model.modelstorage import _record_eval_pyson
 from trytond.config import config
 from trytond.exceptions import UserError
-from trytond.tools import slugify
+from trytond.tools import slugify, grouped_slice, is_instance_method
+from trytond.cache import freeze
+
+logger = logging.getLogger(__name__)
 
 MEDIA_TYPE = config.get('html_report', 'type', default='screen')
 RAISE_USER_ERRORS = config.getboolean('html_report', 'raise_user_errors',
     default=False)
 DEFAULT_MIME_TYPE = config.get('html_report', 'mime_type', default='image/png')
+PDF_PROCESSES = config.getint('html_report', 'pdf_processes', default=0)
+SINGLE_LAYOUT = config.getboolean('html_report', 'single_layout',
+    default=False)
+if SINGLE_LAYOUT and not RECORD_PAGES_SUPPORTED:
+    logger.warning('The single_layout option requires Weasyprint 52, '
+        'the records of single reports are laid out separately')
+    SINGLE_LAYOUT = False
+ZIP_SPOOL_SIZE = config.getint('html_report', 'zip_spool_size',
+    default=16 * 1024 * 1024)
+TEMPLATE_CACHE_SIZE = config.getint('html_report', 'template_cache_size',
+    default=256)
+SYMBOL_CACHE_SIZE = config.getint('html_report', 'symbol_cache_size',
+    default=1024)
+
+# Compiled templates keyed by environment and source hash
+_template_cache = LRUCache('html_report.template',
+    size_limit=TEMPLATE_CACHE_SIZE)
+# Record paths used by the templates keyed by environment and source hash
+_paths_cache = LRUCache('html_report.record_paths',
+    size_limit=TEMPLATE_CACHE_SIZE)
+# If templates read the records keyed by environment and source hash
+_record_use_cache = LRUCache('html_report.record_use',
+    size_limit=TEMPLATE_CACHE_SIZE)
+# QR codes and barcodes as data URIs keyed by type, value and options
+_symbol_cache = LRUCache('html_report.symbol', size_limit=SYMBOL_CACHE_SIZE)
+RELATIONAL_TYPES = {'many2one', 'one2one', 'reference', 'one2many',
+    'many2many'}
+# ir.lang records used to format values keyed by transaction and code
+_langs = weakref.WeakKeyDictionary()
+
+
+def get_lang(code=None):
+    """
+    Return the ir.lang record of code (by default the report language) shared
+    by all the formatters and filters of the transaction.
+    """
+    if code is None:
+        context = Transaction().context
+        code = context.get('report_lang', Transaction().language)
+    code = code or 'en'
+    langs = _langs.setdefault(Transaction(), {})
+    lang = langs.get(code)
+    if lang is None:
+        # Lang.get() is cached by code and cleared when a language is written
+        lang = langs[code] = Pool().get('ir.lang').get(code)
+    return lang
+
+
+def binary_url(value, filename=None):
+    """
+    Return the URL of the binary value: a short URL served from memory when a
+    PDF is being rendered (see RenderContext.activate()) or a data URI.
+    """
+    mimetype = DEFAULT_MIME_TYPE
+    if filename:
+        mimetype = mimetypes.guess_type(filename)[0]
+    url = register_resource(value, mimetype)
+    if url:
+        return url
+    value = binascii.b2a_base64(value)
+    value = value.decode('ascii')
+    return ('data:%s;base64,%s' % (mimetype, value)).strip()
 
 
 class DualRecordError(Exception):
@@ -53,31 +130,46 @@ class SwitchableTranslations:
     def __init__(self, lang='en', dirname=None, domain=None):
         self.dirname = dirname
         self.domain = domain
-        self.cache = {}
         self.env = None
-        self.current = None
-        self.language = lang
-        self.report = None
+        # The instance is shared by the cached environments so the state of
+        # the current render is kept per thread
+        self._local = threading.local()
         self.set_language(lang)
 
+    @property
+    def current(self):
+        return getattr(self._local, 'current', None)
+
+    @current.setter
+    def current(self, value):
+        self._local.current = value
+
+    @property
+    def language(self):
+        return getattr(self._local, 'language', None)
+
+    @language.setter
+    def language(self, value):
+        self._local.language = value
+
+    @property
+    def report(self):
+        return getattr(self._local, 'report', None)
+
+    @report.setter
+    def report(self, value):
+        self._local.report = value
+
     # TODO: We should implement a context manager
 
     def set_language(self, lang='en'):
         self.language = lang
-        if lang in self.cache:
-            self.current = self.cache[lang]
-            return
-
         context = Transaction().context
         if context.get('report_translations'):
             report_translations = context['report_translations']
             if os.path.isdir(report_translations):
-                self.current = support.Translations.load(
-                    dirname=report_translations,
-                    locales=[lang],
-                    domain=self.domain,
-                    )
-                self.cache[lang] = self.current
+                self.current = load_translations(report_translations, lang,
+                    domain=self.domain)
         else:
             self.report = context.get('html_report', -1)
 
@@ -118,11 +210,13 @@ class SwitchableLanguageExtension(jinja2.ext.Extension):
         self.env = env
         env.extend(
             install_switchable_translations=self._install,
+            switchable_translations=None,
             )
         self.translations = None
 
     def _install(self, translations):
         self.env.install_gettext_translations(translations)
+        self.env.switchable_translations = translations
         self.translations = translations
 
     def parse(self, parser):
@@ -144,8 +238,95 @@ class SwitchableLanguageExtension(jinja2.ext.Extension):
 
 
 class Formatter:
+    '''
+    Format the values of the fields of the records.
+
+    The same formatter is shared by the DualRecords of a report execution,
+    so it also holds the indexes loaded for all of them.
+    '''
     def __init__(self):
-        self.__langs = {}
+        self.__resources = {}
+        self.__records = {}
+        self.__selections = {}
+        self.__dual_records = {}
+
+    def get_dual_record(self, record):
+        """
+        Return the DualRecord of record, which is the same one for all the
+        instances of a record with the same context.
+        """
+        key = (record.__name__, record.id)
+        dual_record = self.__dual_records.get(key)
+        if (dual_record is None
+                or (dual_record.raw is not record
+                    and dual_record.raw._context != record._context)):
+            dual_record = DualRecord(record, self)
+            self.__dual_records[key] = dual_record
+        return dual_record
+
+    def _get_current_record(self, record):
+        """
+        Return record instantiated in the context of the transaction, so its
+        values are translated to the current language.
+
+        It is browsed together with all the records of its browse group, so
+        the values are read at once for all of them.
+        """
+        key = (record.__name__, Transaction().language)
+        records = self.__records.setdefault(key, {})
+        if record.id not in records:
+            Model = Pool().get(record.__name__)
+            ids = [x for x in record._ids if x not in records]
+            if record.id not in ids:
+                ids.append(record.id)
+            records.update((x.id, x) for x in Model.browse(ids))
+        return records[record.id]
+
+    def _get_selection(self, record, field):
+        """
+        Return the translated selection of field as a dictionary or None if
+        it depends on the record
+        """
+        key = (record.__name__, field.name, Transaction().language)
+        if key not in self.__selections:
+            Model = Pool().get(record.__name__)
+            selection = Model.fields_get([field.name])[field.name][
+                'selection']
+            if not isinstance(selection, (tuple, list)):
+                if is_instance_method(Model, selection):
+                    selection = None
+                else:
+                    selection = getattr(Model, selection)()
+            if selection is not None:
+                selection = dict(selection)
+            self.__selections[key] = selection
+        return self.__selections[key]
+
+    def get_resources(self, model, record):
+        """
+        Return the records of model (ir.attachment or ir.note) linked to
+        record.
+
+        They are searched at once for all the records of the browse group of
+        record and indexed by resource.
+        """
+        Model = Pool().get(model)
+        resources = self.__resources.setdefault(model, {})
+        resource = str(record)
+        if resource not in resources:
+            group = ['%s,%s' % (record.__name__, id_) for id_ in record._ids]
+            group = [x for x in group if x not in resources]
+            if resource not in group:
+                group.append(resource)
+            for sub_group in grouped_slice(group):
+                sub_group = list(sub_group)
+                for resource_ in sub_group:
+                    resources[resource_] = []
+                for value in Model.search([
+                            ('resource', 'in', sub_group),
+                            ]):
+                    resources[str(value.resource)].append(value)
+        return resources[resource]
 
     def format(self, record, field, value):
         formatter = '_formatted_%s' % field._type
@@ -153,14 +334,7 @@ class Formatter:
         return method(record, field, value)
 
     def _get_lang(self):
-        Lang = Pool().get('ir.lang')
-        locale = Transaction().context.get('report_lang', Transaction().language)
-        lang = self.__langs.get(locale)
-        if lang:
-            return lang
-        lang, = Lang.search([('code', '=', locale or 'en')], limit=1)
-        self.__langs[locale] = lang
-        return lang
+        return get_lang()
 
     def _formatted_raw(self, record, field, value):
         return value
@@ -179,7 +353,7 @@ class Formatter:
     def _formatted_one2many(self, record, field, value):
         if not value:
             return value
-        return [FormattedRecord(x) for x in value]
+        return [FormattedRecord(x, self) for x in value]
 
     def _formatted_many2many(self, record, field, value):
         return self._formatted_one2many(record, field, value)
@@ -210,8 +384,7 @@ class Formatter:
     def _formatted_char(self, record, field, value):
         if value is None:
             return ''
-        Model = Pool().get(record.__name__)
-        value = getattr(Model(record.id), field.name)
+        value = getattr(self._get_current_record(record), field.name)
         return value.replace('\n', '<br/>')
 
     def _formatted_text(self, record, field, value):
@@ -248,47 +421,65 @@ class Formatter:
     def _formatted_binary(self, record, field, value):
         if not value:
             return
-        value = binascii.b2a_base64(value)
-        value = value.decode('ascii')
-        filename = field.filename
-        mimetype = DEFAULT_MIME_TYPE
-        if filename:
-            mimetype = mimetypes.guess_type(filename)[0]
-        return ('data:%s;base64,%s' % (mimetype, value)).strip()
+        return binary_url(value, field.filename)
 
     def _formatted_selection(self, record, field, value):
         if value is None:
             return ''
 
-        Model = Pool().get(record.__name__)
-        record = Model(record.id)
-        t  = TranslatedSelection(field.name)
-        return t.__get__(record, record).replace('\n', '<br/>')
+        selection = self._get_selection(record, field)
+        if selection is None:
+            record = self._get_current_record(record)
+            t = TranslatedSelection(field.name)
+            return t.__get__(record, record).replace('\n', '<br/>')
+        # None and '' are equivalent
+        if value == '' and value not in selection and None in selection:
+            value = None
+        return selection.get(value, value).replace('\n', '<br/>')
 
     # TODO: Implement: dict, multiselection
 
 
 class FormattedRecord:
+    __slots__ = ('_raw_record', '_formatter', '_values')
+
     def __init__(self, record, formatter=None):
         self._raw_record = record
         if formatter:
-            self.__formatter = formatter
+            self._formatter = formatter
         else:
-            self.__formatter = Formatter()
+            self._formatter = Formatter()
+        self._values = {}
 
     def __getattr__(self, name):
+        # The formatted value depends on the language
+        context = Transaction().context
+        key = (name, Transaction().language, context.get('report_lang'))
+        try:
+            value = self._values[key]
+        except KeyError:
+            pass
+        else:
+            # The resource of a binary is only registered when formatted
+            use_resource(value)
+            return value
         value = getattr(self._raw_record, name)
         field = self._raw_record._fields.get(name)
         if not field:
             return value
-        return self.__formatter.format(self._raw_record, field, value)
+        value = self._formatter.format(self._raw_record, field, value)
+        self._values[key] = value
+        return value
 
 
 class DualRecord:
+    __slots__ = ('raw', 'render', '_formatter')
+
     def __init__(self, record, formatter=None):
         self.raw = record
         if not formatter:
             formatter = Formatter()
+        self._formatter = formatter
         self.render = FormattedRecord(record, formatter)
 
     def __getattr__(self, name):
@@ -306,22 +497,51 @@ class DualRecord:
         if not value:
             return value
         if field._type in {'many2one', 'one2one', 'reference'}:
-            return DualRecord(value)
-        return [DualRecord(x) for x in value]
+            return self._formatter.get_dual_record(value)
+        return [self._formatter.get_dual_record(x) for x in value]
 
     @property
     def _attachments(self):
-        pool = Pool()
-        Attachment = pool.get('ir.attachment')
-        return [DualRecord(x) for x in
-            Attachment.search([('resource', '=', str(self.raw))])]
+        return [self._formatter.get_dual_record(x) for x in
+            self._formatter.get_resources('ir.attachment', self.raw)]
 
     @property
     def _notes(self):
-        pool = Pool()
-        Note = pool.get('ir.note')
-        return [DualRecord(x) for x in
-            Note.search([('resource', '=', str(self.raw))])]
+        return [self._formatter.get_dual_record(x) for x in
+            self._formatter.get_resources('ir.note', self.raw)]
+
+
+def _prefetch(records, tree, declared, path=()):
+    # Reading a field of a record reads it for all the records of its browse
+    # group, and the related records share a browse group too, so walking the
+    # tree level by level reads each path with a constant number of queries
+    for name, subtree in tree.items():
+        subpath = path + (name,)
+        related = []
+        try:
+            for record in records:
+                field = record._fields.get(name)
+                if field is None:
+                    continue
+                # The templates may only read function fields for some
+                # records so they are computed only when declared
+                if (isinstance(field, fields.Function)
+                        and subpath not in declared):
+                    break
+                value = getattr(record, name)
+                if not subtree or field._type not in RELATIONAL_TYPES:
+                    continue
+                if isinstance(value, (list, tuple)):
+                    related.extend(value)
+                elif isinstance(value, Model):
+                    related.append(value)
+        except Exception:
+            # The records are read again when rendered
+            logger.warning('Could not prefetch "%s"', '.'.join(subpath),
+                exc_info=True)
+            continue
+        if related:
+            _prefetch(related, subtree, declared, subpath)
 
 
 class HTMLReportMixin:
@@ -331,7 +551,8 @@ class HTMLReportMixin:
     @classmethod
     def _get_dual_records(cls, ids, model, data):
         records = cls._get_records(ids, model, data)
-        return [DualRecord(x) for x in records]
+        formatter = Formatter()
+        return [formatter.get_dual_record(x) for x in records]
 
     @classmethod
     def get_templates_jinja(cls, action):
@@ -361,10 +582,14 @@ class HTMLReportMixin:
         # use DualRecord when template extension is jinja
         data['html_dual_record'] = True
         records = []
+        extension = data.get('output_format', action.extension or 'pdf')
+        render_context = RenderContext()
         with Transaction().set_context(html_report=action.id,
-            address_with_party=False):
+                address_with_party=False), \
+                cls._activate_render_context(render_context, extension):
             if model and ids:
                 records = cls._get_dual_records(ids, model, data)
+                cls.prefetch_records(action, records)
 
                 suffix = '-'.join(r.render.rec_name for r in records[:5])
                 if len(records) > 5:
@@ -374,49 +599,93 @@ class HTMLReportMixin:
                 records = []
                 filename = slugify(action_name)
 
-            # report single and len > 1, return zip file
-            if action.single and len(ids) > 1:
-                content = BytesIO()
-                with zipfile.ZipFile(content, 'w') as content_zip:
-                    for record in records:
-                        oext, rcontent = cls._execute_html_report([record],
-                            data, action)
-                        rfilename = '%s.%s' % (
-                            slugify(record.render.rec_name),
-                            oext)
-                        content_zip.writestr(rfilename, rcontent)
-                content = content.getvalue()
+            # report single and len > 1, return zip file unless the records
+            # are laid out as a single document
+            if (action.single and len(ids) > 1
+                    and not cls._use_single_layout(records, data, action)):
+                # Each document is written to the file as soon as it is
+                # rendered, which is moved to disk when it grows too big
+                with tempfile.SpooledTemporaryFile(
+                        max_size=ZIP_SPOOL_SIZE) as content:
+                    with zipfile.ZipFile(content, 'w') as content_zip:
+                        if cls._use_pdf_processes(records, data, action):
+                            contents = zip(records, cls._render_single_pdfs(
+                                    records, data, action,
+                                    render_context=render_context))
+                            for record, rcontent in contents:
+                                cls._write_zip_document(content_zip,
+                                    record, 'pdf', rcontent)
+                        else:
+                            for record in records:
+                                oext, rcontent = cls._execute_html_report(
+                                    [record], data, action,
+                                    render_context=render_context)
+                                cls._write_zip_document(content_zip,
+                                    record, oext, rcontent)
+                    content.seek(0)
+                    content = content.read()
                 return ('zip', content, False, filename)
 
-            oext, content = cls._execute_html_report(records, data, action)
+            oext, content = cls._execute_html_report(records, data, action,
+                render_context=render_context)
             if not isinstance(content, str):
                 content = bytearray(content) if bytes == str else bytes(content)
         return oext, content, cls.get_direct_print(action), filename
 
     @classmethod
-    def _execute_html_report(cls, records, data, action):
+    @contextmanager
+    def _activate_render_context(cls, render_context, extension):
+        """
+        Activate render_context while rendering a PDF, so the binaries of the
+        records are served from memory to Weasyprint instead of being
+        embedded in the html as data URIs.
+        """
+        if extension == 'pdf':
+            with render_context.activate():
+                yield
+        else:
+            yield
+
+    @classmethod
+    def _write_zip_document(cls, content_zip, record, extension, content):
+        """
+        Write the document of the record into the ZIP of a single report
+        """
+        filename = '%s.%s' % (slugify(record.render.rec_name), extension)
+        # PDF are already compressed
+        compress_type = (zipfile.ZIP_STORED if extension == 'pdf'
+            else zipfile.ZIP_DEFLATED)
+        content_zip.writestr(filename, content, compress_type=compress_type)
+
+    @classmethod
+    def _execute_html_report(cls, records, data, action, render_context=None):
         header_template, main_template, footer_template, last_footer_template = \
                 cls.get_templates_jinja(action)
         extension = data.get('output_format', action.extension or 'pdf')
-        if action.single:
+        if render_context is None:
+            render_context = get_active_render_context() or RenderContext()
+        if cls._use_single_layout(records, data, action):
+            document = cls._render_single_layout(records, data, action,
+                render_context=render_context)
+        elif action.single and extension == 'pdf' and PdfWriter is not None:
+            # Merge the PDF of each record as soon as it is written, so the
+            # layout of its pages can be freed
+            document = merge_pdfs(cls._render_single_pdfs(records, data,
+                    action, render_context=render_context))
+        elif action.single:
             # If document requires a page counter for each record we need to
             # render records individually
+            templates = (header_template, main_template, footer_template,
+                last_footer_template)
             documents = []
             for record in records:
-                content = cls.render_template_jinja(action, main_template,
-                    record=record, records=[record], data=data)
-                header = header_template and cls.render_template_jinja(action,
-                    header_template, record=record, records=[record],
-                    data=data)
-                footer = footer_template and cls.render_template_jinja(action,
-                    footer_template, record=record, records=[record],
-                    data=data)
-                last_footer = last_footer_template and cls.render_template_jinja(action,
-                    last_footer_template, record=record, records=[record],
-                    data=data)
+                content, header, footer, last_footer = (
+                    cls._render_single_html(action, templates, record, data,
+                        render_context=render_context))
                 if extension == 'pdf':
                     documents.append(PdfGenerator(content, header_html=header,
-                            footer_html=footer, last_footer_html=last_footer).render_html())
+                            footer_html=footer, last_footer_html=last_footer,
+                            render_context=render_context).render_html())
                 else:
                     documents.append(content)
             if extension == 'pdf':
@@ -436,11 +705,228 @@ class HTMLReportMixin:
                 last_footer_template, records=records, data=data)
             if extension == 'pdf':
                 document = PdfGenerator(content, header_html=header,
-                    footer_html=footer, last_footer_html=last_footer).render_html().write_pdf()
+                    footer_html=footer, last_footer_html=last_footer,
+                    render_context=render_context).render_html().write_pdf()
             else:
                 document = content
         return extension, document
 
+    @classmethod
+    def _render_single_html(cls, action, templates, record, data,
+            render_context=None):
+        """
+        Return the html of the body, header, footer and last footer of a
+        record of a single report
+
+        The headers and footers that do not read the record are rendered once
+        per render context and reused for the other records, so their layout
+        is reused too.
+        """
+        header_template, main_template, footer_template, last_footer_template = \
+                templates
+        if render_context is None:
+            render_context = get_active_render_context() or RenderContext()
+        content = cls.render_template_jinja(action, main_template,
+            record=record, records=[record], data=data)
+        header, footer, last_footer = (
+            cls._render_single_overlay(action, template, record, data,
+                render_context)
+            for template in (header_template, footer_template,
+                last_footer_template))
+        return content, header, footer, last_footer
+
+    @classmethod
+    def _render_single_overlay(cls, action, template, record, data,
+            render_context):
+        if not template:
+            return template
+        htmls = render_context.overlay_htmls
+        if template in htmls:
+            html, urls = htmls[template]
+            for url in urls:
+                render_context.use_resource(url)
+            return html
+        with render_context.collect_resources() as urls:
+            html = cls.render_template_jinja(action, template, record=record,
+                records=[record], data=data)
+        if not cls.template_uses_records(action, template):
+            htmls[template] = (html, urls)
+        return html
+
+    @classmethod
+    def template_uses_records(cls, action, template_string):
+        """
+        Return if the template reads the record or records variables, in its
+        source or in the templates it references
+        """
+        env = cls.get_cached_environment(action)
+        digest = hashlib.sha256(template_string.encode('utf-8')).hexdigest()
+        key = (id(env), digest)
+        cached = _record_use_cache.get(key)
+        if cached is None:
+            # The environment is kept to not reuse its id
+            cached = _record_use_cache.set(key, (env,
+                    uses_variables(env, template_string)))
+        return cached[1]
+
+    @classmethod
+    def _use_pdf_processes(cls, records, data, action):
+        """
+        Return if the PDFs of the records of a single report are laid out by
+        a pool of processes
+        """
+        extension = data.get('output_format', action.extension or 'pdf')
+        return (PDF_PROCESSES > 0 and action.single and extension == 'pdf'
+            and len(records) > 1)
+
+    @classmethod
+    def _use_single_layout(cls, records, data, action):
+        """
+        Return if the records of a single report are laid out as a single
+        document
+        """
+        extension = data.get('output_format', action.extension or 'pdf')
+        return (SINGLE_LAYOUT and action.single and extension == 'pdf'
+            and len(records) > 1
+            and not cls._use_pdf_processes(records, data, action))
+
+    @classmethod
+    def _render_single_layout(cls, records, data, action,
+            render_context=None):
+        """
+        Return the PDF of the records of a single report laid out as a single
+        document, with the identical headers and footers laid out once.
+
+        Each record starts on a new page and its pages are numbered on their
+        own and get the header and footers of the record. Records that do not
+        share the same head are laid out separately.
+        """
+        templates = cls.get_templates_jinja(action)
+        if render_context is None:
+            render_context = get_active_render_context() or RenderContext()
+        htmls = [cls._render_single_html(action, templates, record, data,
+                render_context=render_context) for record in records]
+        content = join_record_htmls([html[0] for html in htmls])
+        if content is not None:
+            generator = PdfGenerator(content, render_context=render_context,
+                record_pages=True,
+                record_overlays=[html[1:] for html in htmls])
+            return generator.render_html().write_pdf()
+        documents = (PdfGenerator(content, header_html=header,
+                footer_html=footer, last_footer_html=last_footer,
+                render_context=render_context).render_html()
+            for content, header, footer, last_footer in htmls)
+        if PdfWriter is not None:
+            # Merge the PDF of each record as soon as it is written, so the
+            # layout of its pages can be freed
+            return merge_pdfs(document.write_pdf() for document in documents)
+        documents = list(documents)
+        document = documents[0].copy([page for doc in documents
+            for page in doc.pages])
+        return document.write_pdf()
+
+    @classmethod
+    def _render_single_pdfs(cls, records, data, action, render_context=None):
+        """
+        Yield the PDF of each record of a single report in the order of
+        records.
+
+        The html is rendered in the current transaction. When pdf_processes
+        is set, the Weasyprint layout and write_pdf() run in the pool of
+        processes of the server process, see get_pdf_pool().
+        """
+        templates = cls.get_templates_jinja(action)
+        if render_context is None:
+            render_context = get_active_render_context() or RenderContext()
+        if not cls._use_pdf_processes(records, data, action):
+            for record in records:
+                content, header, footer, last_footer = (
+                    cls._render_single_html(action, templates, record, data,
+                        render_context=render_context))
+                yield PdfGenerator(content, header_html=header,
+                    footer_html=footer, last_footer_html=last_footer,
+                    render_context=render_context).render_html().write_pdf()
+            return
+
+        # The worker processes do not use the database
+        pool = get_pdf_pool(PDF_PROCESSES)
+        pending = deque()
+        try:
+            for record in records:
+                with render_context.collect_resources() as urls:
+                    htmls = cls._render_single_html(action, templates, record,
+                        data, render_context=render_context)
+                # The binaries are sent with the html that references them
+                pending.append(pool.submit(render_pdf, *htmls,
+                        resources=render_context.get_resources(urls)))
+                # Limit the rendered html waiting for a process
+                if len(pending) > 2 * PDF_PROCESSES:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        except BrokenProcessPool:
+            discard_pdf_pool(pool)
+            raise
+        finally:
+            # The pool is shared by the next reports
+            for future in pending:
+                future.cancel()
+
+    @classmethod
+    def get_prefetch_paths(cls, action):
+        """
+        Return the set of dotted field paths (e.g. 'lines.product.code') read
+        for all the records of the report before rendering them.
+
+        By default they are the ones of get_template_paths(). Downstream
+        modules can override this method to declare other paths. Function
+        fields are only read for the declared paths.
+        """
+        return cls.get_template_paths(action)
+
+    @classmethod
+    def get_template_paths(cls, action):
+        """
+        Return the set of dotted field paths found by analysing the templates
+        of the action
+        """
+        env = cls.get_cached_environment(action)
+        paths = set()
+        for template_string in cls.get_templates_jinja(action):
+            if not template_string:
+                continue
+            digest = hashlib.sha256(
+                template_string.encode('utf-8')).hexdigest()
+            key = (id(env), digest)
+            cached = _paths_cache.get(key)
+            if cached is None:
+                # The environment is kept to not reuse its id
+                cached = _paths_cache.set(key, (env,
+                        RecordPathCollector(env).collect(template_string)))
+            paths |= {'.'.join(path) for path in cached[1]}
+        return paths
+
+    @classmethod
+    def prefetch_records(cls, action, records):
+        """
+        Read the fields of get_prefetch_paths() for all the records at once
+        instead of one record at a time while rendering
+
+        It is best effort: the paths that can not be read are logged and left
+        to be read while rendering.
+        """
+        paths = cls.get_prefetch_paths(action)
+        declared = set()
+        for path in paths - cls.get_template_paths(action):
+            path = tuple(path.split('.'))
+            declared.update(path[:i] for i in range(1, len(path) + 1))
+        tree = {}
+        for path in paths:
+            node = tree
+            for name in path.split('.'):
+                node = node.setdefault(name, {})
+        _prefetch([record.raw for record in records], tree, declared)
+
     @classmethod
     def get_action(cls, data):
         pool = Pool()
@@ -479,19 +965,20 @@ class HTMLReportMixin:
         template in its reports folder, then you should be able to use:
 
             {% extends 'html_report/report/base.html' %}
+
+        The source is returned with its filename and uptodate function, so
+        the environment reuses the compiled template until it changes.
         """
         Template = Pool().get('html.template')
 
         if '/' in name:
-            module, path = name.split('/', 1)
             try:
-                with file_open(os.path.join(module, path)) as f:
-                    return f.read()
+                asset = get_asset(name)
             except IOError:
                 return None
+            return asset.text, asset.path, asset.uptodate
         else:
-            template, = Template.search([('id', '=', name)], limit=1)
-            return template.all_content
+            return Template.get_jinja_source(name)
 
     @classmethod
     def get_jinja_filters(cls):
@@ -507,24 +994,17 @@ class HTMLReportMixin:
         refer to the Babel `Documentation
         <http://babel.edgewall.org/wiki/Documentation>`_.
         """
-        Lang = Pool().get('ir.lang')
-
         def module_path(name):
-            module, path = name.split('/', 1)
-            with file_open(os.path.join(module, path)) as f:
-                return 'file://' + f.name
+            return get_asset(name).url
 
         def base64(name):
-            module, path = name.split('/', 1)
-            with file_open(os.path.join(module, path), 'rb') as f:
-                value = binascii.b2a_base64(f.read())
-                value = value.decode('ascii')
-                mimetype = mimetypes.guess_type(f.name)[0]
-                return ('data:%s;base64,%s' % (mimetype, value)).strip()
+            return get_asset(name).data_uri
 
         def render(value, digits=2, lang=None, filename=None):
             if not lang:
-                lang, = Lang.search([('code', '=', 'en')], limit=1)
+                # The environment is cached so the language must be resolved
+                # in the transaction of the render
+                lang = get_lang(locale or 'en')
             if isinstance(value, (float, Decimal)):
                 return lang.format('%.*f', (digits, value),
                     grouping=True)
@@ -544,23 +1024,15 @@ class HTMLReportMixin:
             if isinstance(value, str):
                 return value.replace('\n', '<br/>')
             if isinstance(value, bytes):
-                value = binascii.b2a_base64(value)
-                value = value.decode('ascii')
-                mimetype = DEFAULT_MIME_TYPE
-                if filename:
-                    mimetype = mimetypes.guess_type(filename)[0]
-                return ('data:%s;base64,%s' % (mimetype, value)).strip()
+                return binary_url(value, filename)
             return value
 
         locale = Transaction().context.get('report_lang',
             Transaction().language).split('_')[0]
-        lang, = Lang.search([
-                ('code', '=', locale or 'en'),
-                ])
         return {
             'modulepath': module_path,
             'base64': base64,
-            'render': partial(render, lang=lang),
+            'render': render,
             'dateformat': partial(dates.format_date, locale=locale),
             'datetimeformat': partial(dates.format_datetime, locale=locale),
             'timeformat': partial(dates.format_time, locale=locale),
@@ -585,7 +1057,8 @@ class HTMLReportMixin:
             'jinja2.ext.with_', 'jinja2.ext.loopcontrols', 'jinja2.ext.do',
             SwitchableLanguageExtension]
         env = jinja2.Environment(extensions=extensions,
-            loader=jinja2.FunctionLoader(cls.jinja_loader_func))
+            loader=jinja2.FunctionLoader(cls.jinja_loader_func),
+            bytecode_cache=get_bytecode_cache())
         env.filters.update(cls.get_jinja_filters())
 
         context = Transaction().context
@@ -601,9 +1074,34 @@ class HTMLReportMixin:
         return env
 
     @classmethod
-    def label(cls, model, field=None, lang=None):
+    def get_cached_environment(cls, action):
+        """
+        Return the environment of get_environment() for the action, reusing
+        the one built for the same report, action, locale and translations.
+
+        The per render state (language and report of the translations) is
+        reset on the returned environment.
+        """
+        ActionReport = Pool().get('ir.action.report')
+
+        context = Transaction().context
+        locale = context.get(
+            'report_lang', Transaction().language or 'en').split('_')[0]
+        report_translations = context.get('report_translations')
+        if not (report_translations and os.path.isdir(report_translations)):
+            report_translations = None
+        key = (cls.__name__, action.id, locale, report_translations)
+        env = ActionReport._html_environment_cache.get(key)
+        if env is None:
+            env = cls.get_environment()
+            ActionReport._html_environment_cache.set(key, env)
+        elif env.switchable_translations:
+            env.switchable_translations.set_language(locale)
+        return env
 
-        Translation = Pool().get('ir.translation')
+    @classmethod
+    def label(cls, model, field=None, lang=None):
+        pool = Pool()
         if not lang:
             lang = Transaction().language
 
@@ -611,41 +1109,54 @@ class HTMLReportMixin:
             return ''
 
         if field == None:
-            Model = Pool().get('ir.model')
-            model, = Model.search([('model', '=', model)])
-            return model.name
+            Model = pool.get('ir.model')
+            with Transaction().set_context(language=lang):
+                return Model.get_name(model)
         else:
-            translation = Translation.search([
-                    ('name', '=', "%s,%s" % (model, field)),
-                    ('lang', '=', lang),
-                    ], limit=1)
-
-            if translation:
-                translation, = translation
-                return translation.value or translation.src
-            else:
-                translation = Translation.search([
-                        ('name', '=', "%s,%s" % (model, field)),
-                        ('lang', '=', 'en'),
-                        ], limit=1)
-                if translation:
-                    translation, = translation
-                    return translation.value or translation.src
+            Translation = pool.get('ir.translation')
+            name = '%s,%s' % (model, field)
+            label = Translation.get_html_labels(lang).get(name)
+            if label is None and lang != 'en':
+                label = Translation.get_html_labels('en').get(name)
+            return label or field
 
-            return field
+    @classmethod
+    def qrcode(cls, value, **options):
+        key = ('qrcode', value, freeze(options))
+        data = _symbol_cache.get(key)
+        if data is None:
+            qr_code = qrcode.make(value,
+                image_factory=qrcode.image.svg.SvgImage, **options)
+            stream = io.BytesIO()
+            qr_code.save(stream=stream)
+            data = _symbol_cache.set(key, cls.to_base64(stream.getvalue()))
+        return data
+
+    @classmethod
+    def qrcodes(cls, values, **options):
+        "Return the QR codes of values, generating each distinct one once"
+        return [cls.qrcode(value, **options) for value in values]
+
+    @classmethod
+    def barcode(cls, _type, value, **options):
+        key = ('barcode', _type, value, freeze(options))
+        data = _symbol_cache.get(key)
+        if data is None:
+            ean_class = barcode.get_barcode_class(_type)
+            ean_code = ean_class(value, writer=SVGWriter()).render(
+                options or None)
+            data = _symbol_cache.set(key, cls.to_base64(ean_code))
+        return data
 
     @classmethod
-    def qrcode(cls, value):
-        qr_code = qrcode.make(value, image_factory=qrcode.image.svg.SvgImage)
-        stream = io.BytesIO()
-        qr_code.save(stream=stream)
-        return cls.to_base64(stream.getvalue())
+    def barcodes(cls, _type, values, **options):
+        "Return the barcodes of values, generating each distinct one once"
+        return [cls.barcode(_type, value, **options) for value in values]
 
     @classmethod
-    def barcode(cls, _type, value):
-        ean_class = barcode.get_barcode_class(_type)
-        ean_code = ean_class(value, writer=SVGWriter()).render()
-        return cls.to_base64(ean_code)
+    def cache_stats(cls):
+        "Return the name, hits, misses and size of the caches of the module"
+        return list(LRUCache.stats())
 
     def to_base64(image):
         value = binascii.b2a_base64(image)
@@ -666,7 +1177,7 @@ class HTMLReportMixin:
         except:
             Company = None
 
-        env = cls.get_environment()
+        env = cls.get_cached_environment(action)
 
         if records is None:
             records = []
@@ -681,14 +1192,17 @@ class HTMLReportMixin:
             'Decimal': Decimal,
             'label': cls.label,
             'qrcode': cls.qrcode,
+            'qrcodes': cls.qrcodes,
             'barcode': cls.barcode,
+            'barcodes': cls.barcodes,
             }
         if Company:
             context['company'] = DualRecord(Company(
                     Transaction().context.get('company')))
         context.update(cls.local_context())
         try:
-            report_template = env.from_string(template_string)
+            report_template = cls.get_template_from_string(env,
+                template_string)
         except jinja2.exceptions.TemplateSyntaxError as e:
             if RAISE_USER_ERRORS or action.html_raise_user_error:
                 raise UserError(gettext('html_report.template_error',
@@ -703,10 +1217,37 @@ class HTMLReportMixin:
             raise
         return res
 
+    @classmethod
+    def get_template_from_string(cls, env, template_string):
+        """
+        Return the compiled template of env for template_string, compiling
+        it only if the same source was not compiled before
+        """
+        digest = hashlib.sha256(template_string.encode('utf-8')).hexdigest()
+        # The template holds a reference to its environment so the id can
+        # not be reused while the entry is in the cache
+        key = (id(env), digest)
+        template = _template_cache.get(key)
+        if template is None:
+            template = _template_cache.set(key,
+                compile_template(env, template_string))
+        return template
+
     @classmethod
     def local_context(cls):
         return {}
 
+    @classmethod
+    def get_context_names(cls):
+        """
+        Return the names of the variables that render_template_jinja() passes
+        to all the templates, besides the ones of local_context()
+        """
+        return {'report', 'record', 'records', 'data', 'time', 'user',
+            'Decimal', 'label', 'qrcode', 'qrcodes', 'barcode', 'barcodes',
+            'company'}
+
     @classmethod
     def weasyprint_render(cls, content):
-        return weasyprint.HTML(string=content, media_type=MEDIA_TYPE).render()
+        render_context = get_active_render_context() or RenderContext()
+        return render_context.render(content, media_type=MEDIA_TYPE)
@@ -1,4 +1,324 @@
-from weasyprint import HTML, CSS
+import hashlib
+import mimetypes
+import multiprocessing
+import os
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import weasyprint
+from weasyprint import HTML, CSS, default_url_fetcher
+from weasyprint.document import Document
+from weasyprint.fonts import FontConfiguration
+from weasyprint.layout import LayoutContext
+
+from trytond.cache import LRUDict
+
+from .cache import get_file
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+# Scheme of the URLs of the resources registered in a render context
+RESOURCE_SCHEME = 'html-report-resource'
+# Number of laid out headers and footers kept by a render context
+OVERLAY_CACHE_SIZE = 8
+# Number of images decoded by Weasyprint kept by a render context
+IMAGE_CACHE_SIZE = 64
+# Prefix of the named pages of the records joined by join_record_htmls()
+RECORD_PAGE_PREFIX = 'html-report-record-'
+# The page counters of the records rely on the internals of Weasyprint 52,
+# see RecordPageLayoutContext
+RECORD_PAGES_SUPPORTED = weasyprint.__version__.split('.')[0] == '52'
+
+BODY_START = re.compile(r'<body\b[^>]*>', re.IGNORECASE)
+BODY_END = re.compile(r'</body\s*>', re.IGNORECASE)
+
+# Render context of the worker processes, see render_pdf()
+_worker_render_context = None
+# Process id and pool of processes running render_pdf(), see get_pdf_pool()
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+# Render context activated in the thread
+_local = threading.local()
+
+
+class RenderContext:
+    """
+    State shared by the PdfGenerator instances that render a batch of
+    documents.
+
+    Attributes
+    ----------
+    overlays: LRUDict
+        The last OVERLAY_CACHE_SIZE laid out header and footer boxes and
+        their heights, keyed by a hash of the overlay html and of its page
+        layout.
+    resources: dict
+        The mime type and content of the binaries referenced by the html,
+        keyed by their URL, see register_resource().
+    stylesheets: dict
+        The parsed CSS of the page layouts, keyed by their source.
+    image_cache: LRUDict
+        The last IMAGE_CACHE_SIZE images decoded by Weasyprint, keyed by
+        their URL.
+    overlay_htmls: dict
+        The html of the headers and footers that do not depend on the record
+        they are rendered for and the URLs of the resources it references,
+        keyed by their template.
+    """
+    def __init__(self):
+        self.overlays = LRUDict(OVERLAY_CACHE_SIZE)
+        self.overlay_htmls = {}
+        self.resources = {}
+        self.stylesheets = {}
+        self.image_cache = LRUDict(IMAGE_CACHE_SIZE)
+        self._collected = []
+        self._font_config = None
+
+    @property
+    def font_config(self):
+        if self._font_config is None:
+            self._font_config = FontConfiguration()
+        return self._font_config
+
+    def get_stylesheet(self, string):
+        "Return the parsed CSS of string"
+        stylesheet = self.stylesheets.get(string)
+        if stylesheet is None:
+            stylesheet = CSS(string=string, font_config=self.font_config)
+            self.stylesheets[string] = stylesheet
+        return stylesheet
+
+    def render(self, string, stylesheets=None, base_url=None,
+            media_type='print', record_pages=False):
+        """
+        Lay out the html string with the stylesheets sources and return the
+        Weasyprint document, sharing the fonts, images and parsed CSS of the
+        context.
+
+        With record_pages, the pages of each record of an html made by
+        join_record_htmls() are numbered on their own.
+        """
+        html = HTML(string=string, base_url=base_url,
+            url_fetcher=self.url_fetcher, media_type=media_type)
+        stylesheets = [self.get_stylesheet(s) for s in stylesheets or []]
+        if record_pages:
+            return RecordPageDocument._render(html, stylesheets, False,
+                font_config=self.font_config, image_cache=self.image_cache)
+        return html.render(stylesheets=stylesheets,
+            font_config=self.font_config, image_cache=self.image_cache)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make register_resource() add the binaries formatted in the block to
+        this context.
+        """
+        previous = getattr(_local, 'render_context', None)
+        _local.render_context = self
+        try:
+            yield self
+        finally:
+            _local.render_context = previous
+
+    def add_resource(self, data, mime_type=None):
+        "Add data to the resources and return its URL"
+        url = '%s:%s' % (RESOURCE_SCHEME, hashlib.sha256(data).hexdigest())
+        self.resources.setdefault(url, (mime_type, data))
+        self.use_resource(url)
+        return url
+
+    def use_resource(self, url):
+        "Add url to the URLs collected by collect_resources()"
+        for urls in self._collected:
+            urls.add(url)
+
+    @contextmanager
+    def collect_resources(self):
+        """
+        Collect the URLs of the resources added or used while rendering the
+        html of the block in the yielded set.
+        """
+        urls = set()
+        self._collected.append(urls)
+        try:
+            yield urls
+        finally:
+            self._collected.remove(urls)
+
+    def get_resources(self, urls):
+        "Return the resources of urls"
+        return {url: self.resources[url] for url in urls}
+
+    def url_fetcher(self, url):
+        """
+        Weasyprint URL fetcher serving the resources from memory and the
+        local files from the asset cache.
+        """
+        if url.startswith(RESOURCE_SCHEME + ':'):
+            mime_type, data = self.resources[url]
+            return {
+                'string': data,
+                'mime_type': mime_type,
+                'redirected_url': url,
+                }
+        elif url.startswith('file://'):
+            path = url2pathname(urlsplit(url).path)
+            try:
+                asset = get_file(path)
+            except OSError:
+                pass
+            else:
+                return {
+                    'string': asset.data,
+                    'mime_type': mimetypes.guess_type(path)[0],
+                    'redirected_url': url,
+                    'filename': path,
+                    }
+        return default_url_fetcher(url)
+
+
+def get_active_render_context():
+    "Return the render context activated in the thread or None"
+    return getattr(_local, 'render_context', None)
+
+
+def register_resource(data, mime_type=None):
+    """
+    Return the URL of data in the render context activated in the thread or
+    None if there is none, so data must be embedded in the html.
+    """
+    render_context = get_active_render_context()
+    if render_context is not None:
+        return render_context.add_resource(data, mime_type)
+
+
+def use_resource(value):
+    """
+    Tell the render context activated in the thread that value, a string
+    rendered again without registering its resource, is used if it is the
+    URL of a resource.
+    """
+    render_context = get_active_render_context()
+    if (render_context is not None and isinstance(value, str)
+            and value.startswith(RESOURCE_SCHEME + ':')):
+        render_context.use_resource(value)
+
+
+def join_record_htmls(htmls):
+    """
+    Return an html with the body of each of htmls, in the same order, or
+    None if they do not share the same head.
+
+    The body of each html is wrapped in a block with a named page of its own,
+    so each record starts on a new page and its pages can be told apart
+    once laid out, see record_page_keys().
+    """
+    prefix = suffix = None
+    bodies = []
+    for index, html in enumerate(htmls):
+        start = BODY_START.search(html)
+        ends = list(BODY_END.finditer(html))
+        if not start or not ends or ends[-1].start() < start.end():
+            return
+        head, tail = html[:start.end()], html[ends[-1].start():]
+        if prefix is None:
+            prefix, suffix = head, tail
+        elif (head, tail) != (prefix, suffix):
+            return
+        bodies.append('<div style="page: %s%s">%s</div>' % (
+                RECORD_PAGE_PREFIX, index,
+                html[start.end():ends[-1].start()]))
+    if prefix is None:
+        return
+    return prefix + ''.join(bodies) + suffix
+
+
+def record_page_keys(names):
+    """
+    Return the record of each page, given the names of the pages of a
+    document made by join_record_htmls().
+
+    The pages with another name, like the blank ones, belong to the record
+    of the previous page.
+    """
+    keys, key = [], None
+    for name in names:
+        if name and name.startswith(RECORD_PAGE_PREFIX):
+            key = name
+        keys.append(key)
+    return keys
+
+
+def number_record_pages(names):
+    """
+    Return the number of each page in its record and the number of pages of
+    the record, given the names of the pages like record_page_keys().
+    """
+    keys = record_page_keys(names)
+    counts, numbers = Counter(keys), Counter()
+    result = []
+    for key in keys:
+        numbers[key] += 1
+        result.append((numbers[key], counts[key]))
+    return result
+
+
+class RecordPageLayoutContext(LayoutContext):
+    """
+    Weasyprint layout context that sets the page and pages counters of the
+    pages of each record joined by join_record_htmls(), so counter(page) and
+    counter(pages) in the page margins count the pages of the record.
+
+    The counters are set once the document is paginated, before the margin
+    boxes of the first page are made, as CSS can not reset the pages counter.
+    """
+
+    @property
+    def current_page(self):
+        return self._current_page
+
+    @current_page.setter
+    def current_page(self, value):
+        # Weasyprint sets the current page when it lays out the content of a
+        # page, on each pagination pass, right after opening the block
+        # formatting context of the page, and once the document is
+        # paginated, when it makes the margin boxes of each page, outside of
+        # any block formatting context
+        if value == 1 and not self._excluded_shapes_lists:
+            self._number_record_pages()
+        self._current_page = value
+
+    def _number_record_pages(self):
+        # The entry n of the page maker has the name of the page n + 1 and
+        # the counters of the page n
+        names = [next_page['page']
+            for _, next_page, _, _, _ in self.page_maker[:-1]]
+        for number, (page, pages) in enumerate(
+                number_record_pages(names), 1):
+            counter_values = self.page_maker[number][3][1]
+            counter_values['page'] = [page]
+            counter_values['pages'] = [pages]
+
+
+class RecordPageDocument(Document):
+    "Weasyprint document laid out with a RecordPageLayoutContext"
+
+    @classmethod
+    def _build_layout_context(cls, *args, **kwargs):
+        context = super()._build_layout_context(*args, **kwargs)
+        return RecordPageLayoutContext(context.enable_hinting,
+            context.style_for, context.get_image_from_uri,
+            context.font_config, context.counter_style,
+            context.target_collector)
 
 
 class PdfGenerator:
@@ -27,7 +347,8 @@ class PdfGenerator:
 
     def __init__(self, main_html, header_html=None, footer_html=None,
             last_footer_html=None, base_url=None, side_margin=2,
-            extra_vertical_margin=30):
+            extra_vertical_margin=30, render_context=None,
+            record_pages=False, record_overlays=None):
         """
         Parameters
         ----------
@@ -49,6 +370,20 @@ class PdfGenerator:
             the footer.
             The goal is to avoid having the content of `main_html` touching the
             header or the footer.
+        render_context: RenderContext
+            An optional context shared with the other documents of the
+            batch, so identical headers and footers are laid out only once.
+            Defaults to the render context activated in the thread.
+        record_pages: bool
+            Whether main_html joins the records of a single report, see
+            join_record_htmls(). The pages of each record are numbered on
+            their own and the last footer is applied on the last page of each
+            record.
+        record_overlays: list
+            The header, footer and last footer html of each record joined in
+            main_html, used instead of header_html, footer_html and
+            last_footer_html when record_pages is set. The margins of the
+            pages of each record fit its own header and footers.
         """
         self.main_html = main_html
         self.header_html = header_html
@@ -57,13 +392,39 @@ class PdfGenerator:
         self.base_url = base_url
         self.side_margin = side_margin
         self.extra_vertical_margin = extra_vertical_margin
+        self.render_context = (render_context or get_active_render_context()
+            or RenderContext())
+        self.record_pages = record_pages
+        self.record_overlays = record_overlays if record_pages else None
+
+    def _get_overlay_element(self, element: str, html=None):
+        """
+        Return the result of `_compute_overlay_element` from the render
+        context, computing it only for the overlays not laid out recently.
+        """
+        if html is None:
+            html = getattr(self, '{}_html'.format(element))
+        key = hashlib.sha256('\0'.join([
+                    element,
+                    self.OVERLAY_LAYOUT,
+                    self.base_url or '',
+                    html,
+                    ]).encode('utf-8')).hexdigest()
+        overlays = self.render_context.overlays
+        if key in overlays:
+            overlays.move_to_end(key)
+        else:
+            overlays[key] = self._compute_overlay_element(element, html)
+        return overlays[key]
 
-    def _compute_overlay_element(self, element: str):
+    def _compute_overlay_element(self, element: str, html=None):
         """
         Parameters
         ----------
         element: str
             Either 'header' or 'footer'
+        html: str
+            The html of the element, by default the one of the generator
 
         Returns
         -------
@@ -73,12 +434,10 @@ class PdfGenerator:
             The height of this element, which will be then translated in a html
             height
         """
-        html = HTML(
-            string=getattr(self, '{}_html'.format(element)).replace('\n', ''),
-            base_url=self.base_url,
-            )
-        element_doc = html.render(
-            stylesheets=[CSS(string=self.OVERLAY_LAYOUT)])
+        if html is None:
+            html = getattr(self, '{}_html'.format(element))
+        element_doc = self.render_context.render(html.replace('\n', ''),
+            stylesheets=[self.OVERLAY_LAYOUT], base_url=self.base_url)
         element_page = element_doc.pages[0]
         element_body = PdfGenerator.get_element(
             element_page._page_box.all_children(), 'body')
@@ -98,7 +457,7 @@ class PdfGenerator:
         return element_body, element_height
 
     def _apply_overlay_on_main(self, main_doc, header_body=None,
-            footer_body=None, last_footer_body=None):
+            footer_body=None, last_footer_body=None, record_bodies=None):
         """
         Insert the header and the footer in the main document.
 
@@ -112,21 +471,31 @@ class PdfGenerator:
             A representation for an html element in Weasyprint.
         last_footer_body: BlockBox
             A representation for an html element in Weasyprint.
+        record_bodies: list
+            The header, footer and last footer bodies of each record, used
+            instead of the other ones on the pages of the record.
         """
 
-        total_pages = len(main_doc.pages)
-        number_page = 1
-        for page in main_doc.pages:
+        if self.record_pages:
+            keys = record_page_keys([page._page_box.page_type.name
+                    for page in main_doc.pages])
+        else:
+            keys = [None] * len(main_doc.pages)
+        for index, page in enumerate(main_doc.pages):
             page_body = PdfGenerator.get_element(page._page_box.all_children(),
                 'body')
+            last_page = (index + 1 == len(keys)
+                or keys[index + 1] != keys[index])
+            if record_bodies is not None and keys[index] is not None:
+                header_body, footer_body, last_footer_body = record_bodies[
+                    int(keys[index][len(RECORD_PAGE_PREFIX):])]
 
             if header_body:
                 page_body.children += header_body.all_children()
-            if last_footer_body and number_page == total_pages:
+            if last_footer_body and last_page:
                 page_body.children += last_footer_body.all_children()
             if footer_body:
                 page_body.children += footer_body.all_children()
-            number_page += 1
 
     def render_html(self):
         """
@@ -135,43 +504,67 @@ class PdfGenerator:
         pdf: a bytes sequence
             The rendered PDF.
         """
-        if self.header_html:
-            header_body, header_height = self._compute_overlay_element(
-                'header')
+        bodies, heights = self._get_overlays(self.header_html,
+            self.footer_html, self.last_footer_html)
+        record_bodies, record_heights = None, []
+        if self.record_overlays is not None:
+            record_bodies = []
+            for htmls in self.record_overlays:
+                record_body, record_height = self._get_overlays(*htmls)
+                record_bodies.append(record_body)
+                record_heights.append(record_height)
+            # The pages of the records with another name fit any overlay
+            heights = tuple(map(max, zip(heights, *record_heights)))
+        content_print_layout = ('@page {size: A4 portrait; margin: %s;}'
+            % self._get_margins(*heights))
+        for index, record_height in enumerate(record_heights):
+            content_print_layout += '@page %s%s {margin: %s;}' % (
+                RECORD_PAGE_PREFIX, index, self._get_margins(*record_height))
+
+        main_doc = self.render_context.render(self.main_html,
+            stylesheets=[content_print_layout], base_url=self.base_url,
+            record_pages=self.record_pages)
+
+        if record_bodies is not None:
+            self._apply_overlay_on_main(main_doc, *bodies,
+                record_bodies=record_bodies)
+        elif self.header_html or self.footer_html or self.last_footer_html:
+            self._apply_overlay_on_main(main_doc, *bodies)
+
+        return main_doc
+
+    def _get_overlays(self, header_html, footer_html, last_footer_html):
+        """
+        Return the header, footer and last footer bodies of the html and the
+        heights of the header and of the footers.
+        """
+        if header_html:
+            header_body, header_height = self._get_overlay_element('header',
+                header_html)
         else:
             header_body, header_height = None, 0
-        if self.footer_html:
-            footer_body, footer_height = self._compute_overlay_element(
-                'footer')
+        if footer_html:
+            footer_body, footer_height = self._get_overlay_element('footer',
+                footer_html)
         else:
             footer_body, footer_height = None, 0
-        if self.last_footer_html:
+        if last_footer_html:
             last_footer_body, last_footer_height = (
-                self._compute_overlay_element('last_footer'))
+                self._get_overlay_element('last_footer', last_footer_html))
         else:
             last_footer_body, last_footer_height = None, 0
         footer_height += last_footer_height
+        return ((header_body, footer_body, last_footer_body),
+            (header_height, footer_height))
 
-        margins = '{header_size}px {side_margin} {footer_size}px\
+    def _get_margins(self, header_height, footer_height):
+        "Return the margins of the pages with the header and footer heights"
+        return '{header_size}px {side_margin} {footer_size}px\
             {side_margin}'.format(
             header_size=header_height + self.extra_vertical_margin,
             footer_size=footer_height + self.extra_vertical_margin,
             side_margin='{}cm'.format(self.side_margin),
             )
-        content_print_layout = ('@page {size: A4 portrait; margin: %s;}'
-            % margins)
-
-        html = HTML(
-            string=self.main_html,
-            base_url=self.base_url,
-        )
-        main_doc = html.render(stylesheets=[CSS(string=content_print_layout)])
-
-        if self.header_html or self.footer_html or self.last_footer_html:
-            self._apply_overlay_on_main(main_doc, header_body, footer_body,
-                last_footer_body)
-
-        return main_doc
 
     @staticmethod
     def get_element(boxes, element):
@@ -185,3 +578,74 @@ class PdfGenerator:
             if box.element_tag == element:
                 return box
             return PdfGenerator.get_element(box.all_children(), element)
+
+
+def render_pdf(main_html, header_html=None, footer_html=None,
+        last_footer_html=None, resources=None):
+    """
+    Lay out the html and return the bytes of the PDF.
+
+    It is the function run by the worker processes that render single
+    reports in parallel, so the render context is kept for the whole life
+    of the process. resources are the ones of the render context of the
+    caller referenced by the html, which are only kept for this call.
+    """
+    global _worker_render_context
+    if _worker_render_context is None:
+        _worker_render_context = RenderContext()
+    _worker_render_context.resources = dict(resources or {})
+    return PdfGenerator(main_html, header_html=header_html,
+        footer_html=footer_html, last_footer_html=last_footer_html,
+        render_context=_worker_render_context).render_html().write_pdf()
+
+
+def get_pdf_pool(max_workers):
+    """
+    Return the pool of max_workers processes running render_pdf() of the
+    current process, which is created on first use.
+
+    The workers are started by a forkserver that only imports this module,
+    so they do not inherit the threads and the locks held by the threads of
+    the server, and they do not run the main script of the server again.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None or _pdf_pool[0] != os.getpid():
+            mp_context = multiprocessing.get_context('forkserver')
+            mp_context.set_forkserver_preload([__name__])
+            _pdf_pool = (os.getpid(), ProcessPoolExecutor(
+                    max_workers=max_workers, mp_context=mp_context))
+        return _pdf_pool[1]
+
+
+def discard_pdf_pool(pool):
+    "Shut pool down and create a new one on next get_pdf_pool() call"
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None and _pdf_pool[1] is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+
+def merge_pdfs(pdfs):
+    """
+    Return the bytes of a PDF with the pages of all the PDFs of the iterable
+    pdfs, which are consumed one by one.
+
+    It requires pypdf.
+    """
+    first, writer = None, None
+    for pdf in pdfs:
+        if first is None:
+            first = pdf
+            continue
+        if writer is None:
+            writer = PdfWriter()
+            writer.append(BytesIO(first))
+        writer.append(BytesIO(pdf))
+    if writer is None:
+        # Nothing to merge
+        return first
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
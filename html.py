@@ -1,8 +1,22 @@
 import re
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields, sequence_ordered
 from trytond.pyson import Eval, Bool
-from trytond.tools import file_open
 from trytond.pool import Pool
+from trytond.config import config
+from trytond.transaction import Transaction
+from .cache import LRUCache, ClusterCache, get_asset
+
+TEMPLATE_CACHE_SIZE = config.getint('html_report', 'template_cache_size',
+    default=256)
+# Module templates referenced by a template
+MODULE_TEMPLATE = re.compile(
+    r"""{%-?\s*(?:extends|include|import|from)\s+['"]([^'"]+/[^'"]+)['"]""")
+# Templates referenced by an expression or by the id of a template
+OTHER_TEMPLATE = re.compile(
+    r"""{%-?\s*(?:extends|include|import|from)\s+(?!['"][^'"]+/)""")
+# Names of the functions and macros called by a template
+MACRO_CALL = re.compile(r'\b(\w+)\s*\(')
 
 
 class Signature(ModelSQL, ModelView):
@@ -10,6 +24,48 @@ class Signature(ModelSQL, ModelView):
     __name__ = 'html.template.signature'
     name = fields.Char('Name', required=True)
 
+    @property
+    def macro_name(self):
+        "Name of the macros implementing the signature"
+        return self.name.split('(', 1)[0].strip()
+
+    @classmethod
+    def create(cls, vlist):
+        Template = Pool().get('html.template')
+        signatures = super().create(vlist)
+        Template._file_uses_cache.clear()
+        Template.update_uses(Template.search_calling(
+                [s.macro_name for s in signatures]))
+        return signatures
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Template = pool.get('html.template')
+        signatures = sum(args[::2], [])
+        # The templates that called the previous names
+        templates = set(Template.search([
+                    ('uses', 'in', [s.id for s in signatures]),
+                    ]))
+        super().write(*args)
+        # The name of the signature is part of the source of its macros
+        ActionReport._html_environment_cache.clear()
+        ActionReport._html_content_cache.clear()
+        Template._file_uses_cache.clear()
+        templates.update(Template.search_calling(
+                [s.macro_name for s in signatures]))
+        Template.update_uses(list(templates))
+
+    @classmethod
+    def delete(cls, signatures):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Template = pool.get('html.template')
+        super().delete(signatures)
+        ActionReport._html_content_cache.clear()
+        Template._file_uses_cache.clear()
+
 
 class Template(sequence_ordered(), ModelSQL, ModelView):
     'HTML Template'
@@ -28,8 +84,8 @@ class Template(sequence_ordered(), ModelSQL, ModelView):
             'required': Eval('type') == 'macro',
             'invisible': Eval('type') != 'macro',
             })
-    uses = fields.Function(fields.Many2Many('html.template.usage', 'template',
-        'signature', 'Uses'), 'get_uses')
+    uses = fields.Many2Many('html.template.usage', 'template', 'signature',
+        'Uses', readonly=True)
     parent = fields.Many2One('html.template', 'Parent', domain=[
             ('type', 'in', ['base', 'extension']),
             ], states={
@@ -47,6 +103,12 @@ class Template(sequence_ordered(), ModelSQL, ModelView):
             setter='set_content')
     all_content = fields.Function(fields.Text('All Content'),
         'get_all_content')
+    # Sources of the templates keyed by database, id and version
+    _jinja_source_cache = LRUCache('html.template.jinja_source',
+        size_limit=TEMPLATE_CACHE_SIZE)
+    # Signatures used by the templates stored in files keyed by file version
+    _file_uses_cache = ClusterCache('html.template.file_uses',
+        size_limit=TEMPLATE_CACHE_SIZE)
 
     @classmethod
     def __register__(cls, module_name):
@@ -60,9 +122,7 @@ class Template(sequence_ordered(), ModelSQL, ModelView):
         if not self.filename:
             return self.data
         try:
-            with file_open(self.filename, subdir='modules', mode='r',
-                    encoding='utf-8') as fp:
-                return fp.read()
+            return get_asset(self.filename).text
         except IOError:
             return
 
@@ -70,14 +130,113 @@ class Template(sequence_ordered(), ModelSQL, ModelView):
     def set_content(cls, views, name, value):
         cls.write(views, {'data': value})
 
-    def get_uses(self, name):
+    @classmethod
+    def get_used_signatures(cls, content, signatures=None):
+        """
+        Return the signatures, among all of them by default, of the macros
+        called by content
+        """
         Signature = Pool().get('html.template.signature')
 
-        res = []
-        match = re.findall("show_.*\(", self.content or '')
-        for name in match:
-            res += Signature.search([('name', 'like', name + '%')])
-        return [x.id for x in res]
+        names = set(MACRO_CALL.findall(content or ''))
+        if not names:
+            return []
+        if signatures is None:
+            signatures = Signature.search([])
+        return [s for s in signatures if s.macro_name in names]
+
+    @classmethod
+    def search_calling(cls, names):
+        "Return the templates whose content calls any of the macro names"
+        if not names:
+            return []
+        calls = re.compile(r'\b(?:%s)\s*\(' % '|'.join(
+                re.escape(n) for n in names))
+        # The content of the templates stored in files is not in the table
+        templates = cls.search(['OR',
+                ('filename', '!=', None),
+                ] + [('data', 'like', '%' + n + '%') for n in names])
+        return [t for t in templates if calls.search(t.content or '')]
+
+    @classmethod
+    def update_uses(cls, templates):
+        "Store the signatures used by the content of templates"
+        pool = Pool()
+        Signature = pool.get('html.template.signature')
+        TemplateUsage = pool.get('html.template.usage')
+
+        if not templates:
+            return
+        signatures = Signature.search([])
+        TemplateUsage.delete(TemplateUsage.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ]))
+        TemplateUsage.create([{
+                    'template': template.id,
+                    'signature': signature.id,
+                    } for template in templates
+                for signature in cls.get_used_signatures(template.content,
+                    signatures)])
+
+    def get_current_uses(self):
+        """
+        Return the signatures used by the template
+
+        The uses of the templates stored in files are found again from the
+        content of the file each time it is modified, as the stored ones are
+        only updated when the template is written.
+        """
+        Signature = Pool().get('html.template.signature')
+        if not self.filename:
+            return list(self.uses)
+        try:
+            asset = get_asset(self.filename)
+        except IOError:
+            return list(self.uses)
+        key = (self.filename, asset.mtime)
+        signatures = self._file_uses_cache.get(key)
+        if signatures is None:
+            signatures = self._file_uses_cache.set(key,
+                [s.id for s in self.get_used_signatures(asset.text)])
+        return Signature.browse(signatures)
+
+    def get_all_sources(self):
+        """
+        Return the filename, or None, and the source of the template, its
+        parents and the module templates they extend, include or import or
+        None if some of them can not be read or are not referenced by their
+        module path
+        """
+        result, visited = [], set()
+        template = self
+        while template:
+            sources = [(template.filename, template.content or '')]
+            while sources:
+                filename, source = sources.pop()
+                result.append((filename, source))
+                if OTHER_TEMPLATE.search(source):
+                    return
+                for name in MODULE_TEMPLATE.findall(source):
+                    if name in visited:
+                        continue
+                    visited.add(name)
+                    try:
+                        sources.append((name, get_asset(name).text))
+                    except IOError:
+                        return
+            template = template.parent
+        return result
+
+    def get_all_uses(self):
+        """
+        Return the signatures used by the sources of get_all_sources() or
+        None if they can not be found
+        """
+        sources = self.get_all_sources()
+        if sources is None:
+            return
+        return set(self.get_used_signatures(
+                '\n'.join(source for _, source in sources)))
 
     def get_rec_name(self, name):
         res = self.name
@@ -95,6 +254,75 @@ class Template(sequence_ordered(), ModelSQL, ModelView):
             return '{%% macro %s %%}\n%s\n{%% endmacro %%}' % (
                 self.implements.name, self.content)
 
+    @classmethod
+    def get_jinja_source(cls, template_id):
+        """
+        Return the source, filename and uptodate function of the template
+        as expected by jinja2.FunctionLoader or None if it does not exist.
+
+        The source is computed again only when the template, its parent or
+        signature names or its file change. Writing a template clears the
+        cached environments, so only the file needs an uptodate check.
+        """
+        templates = cls.search_read([
+                ('id', '=', int(template_id)),
+                ], limit=1, fields_names=['create_date', 'write_date',
+                'filename', 'parent.name', 'implements.name'])
+        if not templates:
+            return
+        values, = templates
+        asset = None
+        if values['filename']:
+            try:
+                asset = get_asset(values['filename'])
+            except IOError:
+                pass
+        key = (Transaction().database.name, values['id'],
+            values['create_date'], values['write_date'],
+            asset.mtime if asset else None,
+            (values['parent.'] or {}).get('name'),
+            (values['implements.'] or {}).get('name'))
+        source = cls._jinja_source_cache.get(key)
+        if source is None:
+            source = cls._jinja_source_cache.set(key,
+                cls(values['id']).all_content)
+        if asset:
+            return source, asset.path, asset.uptodate
+        return source, None, lambda: True
+
+    @classmethod
+    def create(cls, vlist):
+        ActionReport = Pool().get('ir.action.report')
+        templates = super().create(vlist)
+        cls.update_uses(templates)
+        # The new template may implement a signature used by a report
+        ActionReport._html_content_cache.clear()
+        return templates
+
+    @classmethod
+    def write(cls, *args):
+        ActionReport = Pool().get('ir.action.report')
+        super().write(*args)
+        ActionReport._html_environment_cache.clear()
+        ActionReport._html_content_cache.clear()
+        # The write date does not change between writes of a transaction
+        cls._jinja_source_cache.clear()
+        actions = iter(args)
+        to_update = []
+        for templates, values in zip(actions, actions):
+            if values.keys() & {'data', 'filename'}:
+                to_update.extend(templates)
+        if to_update:
+            cls.update_uses(to_update)
+
+    @classmethod
+    def delete(cls, templates):
+        ActionReport = Pool().get('ir.action.report')
+        super().delete(templates)
+        ActionReport._html_environment_cache.clear()
+        ActionReport._html_content_cache.clear()
+        cls._jinja_source_cache.clear()
+
     @classmethod
     def copy(cls, templates, default=None):
         if default is None:
@@ -115,7 +343,27 @@ class TemplateUsage(ModelSQL):
     template = fields.Many2One('html.template', 'Template', required=True,
         ondelete='CASCADE')
     signature = fields.Many2One('html.template.signature', 'Signature',
-        required=True)
+        required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Template = pool.get('html.template')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        exist = backend.TableHandler.table_exist(cls._table)
+        super().__register__(module_name)
+
+        # Migration from 6.0: uses was computed from the content
+        if exist:
+            cursor.execute(*table.select(table.id, limit=1))
+            if cursor.fetchone():
+                return
+        # The uses of the templates stored in files are found from the file
+        Template.update_uses(Template.search([
+                    ('filename', '=', None),
+                    ]))
 
 
 class ReportTemplate(ModelSQL, ModelView):
@@ -132,6 +380,24 @@ class ReportTemplate(ModelSQL, ModelView):
     template_used = fields.Function(
         fields.Many2One('html.template', 'Template Used'), 'get_template_used')
 
+    @classmethod
+    def create(cls, vlist):
+        ActionReport = Pool().get('ir.action.report')
+        ActionReport._html_content_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        ActionReport = Pool().get('ir.action.report')
+        super().write(*args)
+        ActionReport._html_content_cache.clear()
+
+    @classmethod
+    def delete(cls, templates):
+        ActionReport = Pool().get('ir.action.report')
+        super().delete(templates)
+        ActionReport._html_content_cache.clear()
+
     def get_template_used(self, name):
         Template = Pool().get('html.template')
         if self.template:
@@ -3,14 +3,13 @@ from datetime import datetime
 
 import jinja2
 import jinja2.ext
-from babel import support
 
-import weasyprint
-
-from trytond.tools import file_open
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.report import Report
+from .cache import (get_bytecode_cache, compile_template, load_translations,
+    get_asset)
+from .generator import RenderContext, get_active_render_context
 
 
 class SwitchableTranslations:
@@ -24,7 +23,6 @@ class SwitchableTranslations:
     def __init__(self, lang='en', dirname=None, domain=None):
         self.dirname = dirname
         self.domain = domain
-        self.cache = {}
         self.env = None
         self.current = None
         self.language = lang
@@ -35,20 +33,12 @@ class SwitchableTranslations:
 
     def set_language(self, lang='en'):
         self.language = lang
-        if lang in self.cache:
-            self.current = self.cache[lang]
-            return
-
         context = Transaction().context
         if context.get('report_translations'):
             report_translations = context['report_translations']
             if os.path.isdir(report_translations):
-                self.current = support.Translations.load(
-                    dirname=report_translations,
-                    locales=[lang],
-                    domain=self.domain,
-                    )
-                self.cache[lang] = self.current
+                self.current = load_translations(report_translations, lang,
+                    domain=self.domain)
         else:
             self.report = context.get('html_report', -1)
 
@@ -185,12 +175,11 @@ class HTMLReport(Report):
 
             {% extends 'html_report/report/base.html' %}
         """
-        module, path = name.split('/', 1)
         try:
-            with file_open(os.path.join(module, path)) as f:
-                return f.read()
+            asset = get_asset(name)
         except IOError:
             return None
+        return asset.text, asset.path, asset.uptodate
 
     @classmethod
     def get_environment(cls):
@@ -204,7 +193,8 @@ class HTMLReport(Report):
             'jinja2.ext.with_', 'jinja2.ext.loopcontrols', 'jinja2.ext.do',
             SwitchableLanguageExtension]
         env = jinja2.Environment(extensions=extensions,
-            loader=jinja2.FunctionLoader(cls.jinja_loader_func))
+            loader=jinja2.FunctionLoader(cls.jinja_loader_func),
+            bytecode_cache=get_bytecode_cache())
         env.filters.update(cls.get_jinja_filters())
 
         context = Transaction().context
@@ -229,13 +219,14 @@ class HTMLReport(Report):
         # Update header and footer in context
         company = localcontext['company']
         localcontext.update({
-                'header': env.from_string(company.header_html or ''),
-                'footer': env.from_string(company.footer_html or ''),
+                'header': compile_template(env, company.header_html or ''),
+                'footer': compile_template(env, company.footer_html or ''),
                 'time': datetime.now(),
                 })
-        report_template = env.from_string(template_string)
+        report_template = compile_template(env, template_string)
         return report_template.render(**localcontext)
 
     @classmethod
     def weasyprint(cls, data, options=None):
-        return weasyprint.HTML(string=data).write_pdf()
+        render_context = get_active_render_context() or RenderContext()
+        return render_context.render(data).write_pdf()
@@ -125,6 +125,9 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'pdf_merge': ['pypdf >= 3.0'],
+        },
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
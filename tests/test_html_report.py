@@ -3,6 +3,7 @@
 # the full copyright notices and license terms.
 import unittest
 import doctest
+from io import BytesIO
 from trytond.tests.test_tryton import (ModuleTestCase, with_transaction,
     activate_module)
 from trytond.tests.test_tryton import suite as test_suite
@@ -10,6 +11,10 @@ from trytond.pool import Pool
 from trytond.tools import file_open
 from trytond.transaction import Transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.html_report.generator import (RECORD_PAGE_PREFIX,
+    RECORD_PAGES_SUPPORTED, PdfGenerator, PdfWriter, join_record_htmls,
+    merge_pdfs, number_record_pages)
 
 SCENARIOS = [
     'stock_dependency_scenario.rst',
@@ -103,6 +108,288 @@ class HtmlReportTestCase(ModuleTestCase):
             self.assertTrue('Nombre' in content, True)
             self.assertTrue('Modelo' in content, True)
 
+    @with_transaction()
+    def test_template_cache(self):
+        'Test environments and compiled templates are reused'
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        ModelReport = pool.get('ir.model.report', type='report')
+
+        report, = ActionReport.create([{
+            'name': 'Models',
+            'model': 'ir.model',
+            'report_name': 'ir.model.report',
+            'template_extension': 'jinja',
+            'extension': 'html',
+            }])
+
+        env = ModelReport.get_cached_environment(report)
+        self.assertIs(ModelReport.get_cached_environment(report), env)
+
+        template = ModelReport.get_template_from_string(env, '{{ 1 + 1 }}')
+        self.assertIs(
+            ModelReport.get_template_from_string(env, '{{ 1 + 1 }}'),
+            template)
+        self.assertEqual(template.render(), '2')
+
+    @with_transaction()
+    def test_prefetch_paths(self):
+        'Test record paths are found in templates'
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Template = pool.get('html.template')
+        ModelReport = pool.get('ir.model.report', type='report')
+
+        tpl_models, = Template.create([{
+                    'name': 'Models',
+                    'type': 'base',
+                    'content': (
+                        '{% macro show_fields(model) %}'
+                        '{% for field in model.fields %}'
+                        '{{ field.render.name }}{{ field.raw.module }}'
+                        '{% endfor %}'
+                        '{% endmacro %}'
+                        '{% for model in records %}'
+                        '{{ model.render.name }}{{ show_fields(model) }}'
+                        '{% endfor %}'),
+                    }])
+        report, = ActionReport.create([{
+            'name': 'Models',
+            'model': 'ir.model',
+            'report_name': 'ir.model.report',
+            'template_extension': 'jinja',
+            'extension': 'html',
+            'html_template': tpl_models,
+            }])
+
+        self.assertEqual(ModelReport.get_prefetch_paths(report), {
+                'name', 'fields', 'fields.name', 'fields.module'})
+
+    @with_transaction()
+    def test_macro_imports(self):
+        'Test the macros used by the templates of a report are imported'
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Signature = pool.get('html.template.signature')
+        Template = pool.get('html.template')
+
+        sig_outer, sig_inner, sig_header = Signature.create([
+                {'name': 'outer_macro(value)'},
+                {'name': 'inner_macro(value)'},
+                {'name': 'header_macro()'},
+                ])
+        outer, inner, header_macro = Template.create([{
+                    'name': 'Outer',
+                    'type': 'macro',
+                    'implements': sig_outer,
+                    'content': '[{{ inner_macro(value) }}]',
+                    }, {
+                    'name': 'Inner',
+                    'type': 'macro',
+                    'implements': sig_inner,
+                    'content': '{{ value }}',
+                    }, {
+                    'name': 'Header Macro',
+                    'type': 'macro',
+                    'implements': sig_header,
+                    'content': 'Header',
+                    }])
+        body, header = Template.create([{
+                    'name': 'Body',
+                    'type': 'base',
+                    'content': '{{ outer_macro(1) }}',
+                    }, {
+                    'name': 'Header',
+                    'type': 'header',
+                    'content': '<header>{{ header_macro() }}</header>',
+                    }])
+        report, = ActionReport.create([{
+            'name': 'Models',
+            'model': 'ir.model',
+            'report_name': 'ir.model.report',
+            'template_extension': 'jinja',
+            'extension': 'html',
+            'html_template': body,
+            'html_header_template': header,
+            'html_templates': [('create', [
+                            {'signature': sig_outer, 'template': outer},
+                            {'signature': sig_inner, 'template': inner},
+                            {'signature': sig_header,
+                                'template': header_macro},
+                            ])],
+            }])
+
+        self.assertEqual(report.html_content, '\n'.join([
+                    '{%% from "%s" import inner_macro with context %%}'
+                    % inner.id,
+                    '{%% from "%s" import outer_macro with context %%}'
+                    % outer.id,
+                    '',
+                    '{{ outer_macro(1) }}',
+                    ]))
+        self.assertEqual(report.html_header_content, '\n'.join([
+                    '{%% from "%s" import header_macro with context %%}'
+                    % header_macro.id,
+                    '',
+                    '<header>{{ header_macro() }}</header>',
+                    ]))
+
+        # Macros calling each other are defined in the same template
+        Template.write([inner], {'content': '{{ outer_macro(value) }}'})
+        report = ActionReport(report.id)
+        content = report.html_content
+        self.assertNotIn('{% from', content)
+        self.assertIn('{% macro outer_macro(value) %}', content)
+        self.assertIn('{% macro inner_macro(value) %}', content)
+        self.assertTrue(content.endswith('{{ outer_macro(1) }}'))
+
+    @with_transaction()
+    def test_template_uses_migration(self):
+        'Test the uses of the templates are filled on update'
+        pool = Pool()
+        Signature = pool.get('html.template.signature')
+        Template = pool.get('html.template')
+        TemplateUsage = pool.get('html.template.usage')
+
+        signature, = Signature.create([{'name': 'migrated_macro(value)'}])
+        template, = Template.create([{
+                    'name': 'Body',
+                    'type': 'base',
+                    'content': '{{ migrated_macro(1) }}',
+                    }])
+        self.assertEqual(list(template.uses), [signature])
+
+        # Databases updated from the computed uses have no usage
+        TemplateUsage.delete(TemplateUsage.search([]))
+        TemplateUsage.__register__('html_report')
+
+        template = Template(template.id)
+        self.assertEqual(list(template.uses), [signature])
+
+    @with_transaction()
+    def test_production_report(self):
+        'Test the production report renders with its macros'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Production = pool.get('production')
+        ProductTemplate = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        ProductionReport = pool.get('production.production', type='report')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            template, = ProductTemplate.create([{
+                        'name': 'Bicycle',
+                        'type': 'goods',
+                        'producible': True,
+                        'default_uom': unit,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+            warehouse, = Location.search([('type', '=', 'warehouse')])
+            production, = Production.create([{
+                        'product': product,
+                        'quantity': 2,
+                        'uom': unit,
+                        'warehouse': warehouse,
+                        'location': warehouse.production_location,
+                        'company': company,
+                        }])
+
+            ext, content, _, _ = ProductionReport.execute([production.id], {
+                    'output_format': 'html',
+                    })
+        self.assertEqual(ext, 'html')
+        self.assertIn('Bicycle', content)
+
+    @unittest.skipIf(PdfWriter is None, 'requires pypdf')
+    def test_merge_pdfs(self):
+        'Test the PDFs of the records of a single report are merged'
+        from pypdf import PdfReader
+
+        def record_pdf(*widths):
+            writer = PdfWriter()
+            for width in widths:
+                writer.add_blank_page(width=width, height=100)
+            output = BytesIO()
+            writer.write(output)
+            return output.getvalue()
+
+        pdfs = [record_pdf(100, 101), record_pdf(102), record_pdf(103, 104)]
+        reader = PdfReader(BytesIO(merge_pdfs(iter(pdfs))))
+        self.assertEqual([page.mediabox.width for page in reader.pages],
+            [100, 101, 102, 103, 104])
+        self.assertEqual(merge_pdfs(iter(pdfs[:1])), pdfs[0])
+        self.assertIsNone(merge_pdfs(iter([])))
+
+    def test_record_pages(self):
+        'Test the pages of the records of a single layout are numbered'
+        head = '<html><head><title>R</title></head><body class="a">'
+        html = join_record_htmls([
+                head + 'first</body></html>',
+                head + 'second</body></html>',
+                ])
+        self.assertEqual(html, head
+            + '<div style="page: %s0">first</div>' % RECORD_PAGE_PREFIX
+            + '<div style="page: %s1">second</div>' % RECORD_PAGE_PREFIX
+            + '</body></html>')
+        self.assertIsNone(join_record_htmls([
+                    head + 'first</body></html>',
+                    '<html><body>second</body></html>',
+                    ]))
+
+        names = [RECORD_PAGE_PREFIX + '0', RECORD_PAGE_PREFIX + '0', '',
+            RECORD_PAGE_PREFIX + '1']
+        self.assertEqual(number_record_pages(names),
+            [(1, 3), (2, 3), (3, 3), (1, 1)])
+
+    @unittest.skipUnless(RECORD_PAGES_SUPPORTED, 'requires Weasyprint 52')
+    def test_record_page_counters(self):
+        'Test the page counters of the records of a single layout'
+        from weasyprint.formatting_structure.boxes import MarginBox, TextBox
+
+        head = ('<html><head><style>@page { @bottom-right {'
+            'content: counter(page) " / " counter(pages); } }</style>'
+            '</head><body>')
+        html = join_record_htmls([
+                head + '<p style="break-after: page">1</p><p>2</p>'
+                '</body></html>',
+                head + '<p>3</p></body></html>',
+                ])
+        document = PdfGenerator(html, record_pages=True).render_html()
+
+        def margin_text(page):
+            return ''.join(box.text
+                for margin in page._page_box.children
+                if isinstance(margin, MarginBox)
+                for box in margin.descendants()
+                if isinstance(box, TextBox))
+        self.assertEqual([margin_text(p) for p in document.pages],
+            ['1 / 2', '2 / 2', '1 / 1'])
+
+    @unittest.skipUnless(RECORD_PAGES_SUPPORTED, 'requires Weasyprint 52')
+    def test_record_overlays(self):
+        'Test the pages of each record of a single layout get its header'
+        from weasyprint.formatting_structure.boxes import TextBox
+
+        html = join_record_htmls([
+                '<html><body><p style="break-after: page">1</p><p>2</p>'
+                '</body></html>',
+                '<html><body><p>3</p></body></html>',
+                ])
+        document = PdfGenerator(html, record_pages=True, record_overlays=[
+                ('<header>First</header>', None, None),
+                ('<header>Second</header>', None, None),
+                ]).render_html()
+
+        def page_text(page):
+            return ''.join(box.text
+                for box in page._page_box.descendants()
+                if isinstance(box, TextBox))
+        self.assertEqual([page_text(p) for p in document.pages],
+            ['1First', '2First', '3Second'])
+
 def suite():
     suite = test_suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
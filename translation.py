@@ -1,12 +1,57 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from types import MappingProxyType
+
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from babel._compat import StringIO, BytesIO
 from babel.messages.extract import extract as babel_extract
 import jinja2
 
-__all__ = ['ReportTranslationSet']
+from .cache import ClusterCache
+
+__all__ = ['Translation', 'ReportTranslationSet']
+
+
+class Translation(metaclass=PoolMeta):
+    __name__ = 'ir.translation'
+    # Field labels by language used by the label() helper of the templates
+    _html_label_cache = ClusterCache('ir.translation.html_label',
+        size_limit=64)
+
+    @classmethod
+    def get_html_labels(cls, lang):
+        """
+        Return a read-only dictionary mapping "model,field" to the label of
+        the field in lang
+        """
+        labels = cls._html_label_cache.get(lang)
+        if labels is None:
+            labels = {}
+            for translation in cls.search_read([
+                        ('lang', '=', lang),
+                        ('type', '=', 'field'),
+                        ], fields_names=['name', 'src', 'value']):
+                labels.setdefault(translation['name'],
+                    translation['value'] or translation['src'])
+            labels = cls._html_label_cache.set(lang,
+                MappingProxyType(labels))
+        return labels
+
+    @classmethod
+    def create(cls, vlist):
+        cls._html_label_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._html_label_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, translations):
+        cls._html_label_cache.clear()
+        super().delete(translations)
 
 
 class ReportTranslationSet(metaclass=PoolMeta):